@@ -3,6 +3,7 @@ import pandas as pd
 import sage.all
 import snappy
 import taskdb2
+import finite
 
 num_tet = {'m':5, 's':6, 'v':7, 't':8, 'o':9}
 def sort_key(datum):
@@ -30,17 +31,33 @@ def extract_john_to_csv():
     out.writerow(['name', 'description'])
     out.writerows(ans)
 
-def order_via_magma(name):
+def order_via_magma(name, cache=None):
+    """
+    When given a cache as in finite.has_finite_fundamental_group, any
+    order recorded there is used instead of calling Magma, and new
+    results are saved to it.
+    """
     M = snappy.Manifold(name)
+    if cache is not None:
+        key = finite.filling_key(M)
+        record = cache.get(key)
+        if record is not None and record['order'] is not None:
+            return record['order']
     G = M.fundamental_group()
     if G.num_generators() == 0:
-        return 1
-    MG = sage.all.magma(G)
-    return MG.Order().sage()
+        order = 1
+    else:
+        MG = sage.all.magma(G)
+        order = MG.Order().sage()
+    if cache is not None and record is None:
+        is_finite = order not in [0, sage.all.infinity]
+        cache[key] = {'finite':is_finite, 'order':int(order) if is_finite else None,
+                      'presentation':finite.presentation_record(G)}
+    return order
 
-def check_with_magma():
+def check_with_magma(cache=None):
     df = pd.read_csv('berge_finite.csv')
-    df['order'] = df.name.apply(order_via_magma)
+    df['order'] = df.name.apply(lambda name:order_via_magma(name, cache))
     df.to_csv('berge_finite_checked.csv', index=False)
     return df
 
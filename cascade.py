@@ -0,0 +1,141 @@
+"""
+Sorting closed manifolds into isometry classes by a cascade of
+invariants, cheapest first, as weed.refine_classes did by hand.  Each
+invariant is only computed for manifolds that all the cheaper ones
+failed to separate from some other manifold.
+"""
+
+import collections
+import session, weed
+
+def fold_chern_simons(cs):
+    """
+    Chern-Simons is defined mod 1/2 and changes sign with orientation,
+    so this is the representative in [0, 1/4].
+
+    >>> fold_chern_simons(-0.1), fold_chern_simons(0.4)
+    (0.1, 0.1)
+    """
+    x = cs % 0.5
+    return round(min(x, 0.5 - x), 12)
+
+# Each stage is (name, function of a session.FillingSession, tolerance),
+# where a tolerance of None means values must be equal.  Homology needs
+# no shapes, and the two group hashes share one subgroup search.
+default_stages = [
+    ('homology', lambda S: S.homology()['H_1'], None),
+    ('volume', lambda S: S.volume(), 1e-9),
+    ('chern_simons', lambda S: fold_chern_simons(S.chern_simons()), 1e-9),
+    ('group_hash', lambda S: S.group_hashes()[0], None),
+    ('group_hash_10', lambda S: S.group_hashes()[1], None),
+    ('simple_quotient_hash', lambda S: S.simple_quotient_hash(), None)]
+
+def base_order(name):
+    """
+    >>> sorted(['m004(5, 1)', 'm003(1, 2)', 'm004(1, 2)'], key=base_order)
+    ['m003(1, 2)', 'm004(1, 2)', 'm004(5, 1)']
+    """
+    return session.parse_filling_name(name)[0], name
+
+def split_by_value(names, values, tol=None):
+    """
+    Splits names into groups with equal values or, given a tolerance,
+    into chains of values where consecutive ones are within tol.
+
+    >>> split_by_value('abcd', [1.0, 2.0, 1.0 + 1e-12, 3.0], 1e-9)
+    [['a', 'c'], ['b'], ['d']]
+    >>> split_by_value('abc', ['x', 'y', 'x'])
+    [['a', 'c'], ['b']]
+    """
+    if tol is None:
+        groups = collections.OrderedDict()
+        for name, value in zip(names, values):
+            groups.setdefault(value, []).append(name)
+        return list(groups.values())
+    position = dict((name, i) for i, name in enumerate(names))
+    pairs = sorted(zip(values, names))
+    groups = [[pairs[0][1]]]
+    for (u, a), (v, b) in zip(pairs, pairs[1:]):
+        if v - u > tol:
+            groups.append([])
+        groups[-1].append(b)
+    return [sorted(g, key=position.get) for g in groups]
+
+class Cascade:
+    """
+    Runs the stages on a list of closed manifold names.  Values are
+    kept in the dict-like store, e.g. a store.ReprStore, under
+    (stage name, manifold name), so a rerun or a larger census only
+    computes what is new.  The counter 'stats' records how many values
+    each stage computed, and how many groups each stage settled.
+    """
+    def __init__(self, stages=None, store=None):
+        self.stages = default_stages if stages is None else stages
+        self.store = dict() if store is None else store
+        self.stats = collections.Counter()
+
+    def value(self, stage, S):
+        key = (stage[0], S.name)
+        if key not in self.store:
+            self.stats[stage[0]] += 1
+            self.store[key] = stage[1](S)
+        return self.store[key]
+
+    def split(self, names):
+        """
+        The groups left after all the invariant stages.  Each group is
+        taken through the remaining stages before the next, with its
+        members in order of base so that session.base_cache gets hits.
+        A member keeps its FillingSession, and so its solved filling,
+        until it is separated from the rest.
+        """
+        sessions = dict()
+        ans = []
+        stack = [(list(names), 0)]
+        while stack:
+            group, k = stack.pop()
+            if k == len(self.stages):
+                ans.append(group)
+                continue
+            stage = self.stages[k]
+            values = dict()
+            for name in sorted(group, key=base_order):
+                if name not in sessions:
+                    sessions[name] = session.FillingSession(name, bases=session.base_cache)
+                values[name] = self.value(stage, sessions[name])
+            parts = split_by_value(group, [values[name] for name in group], stage[2])
+            for part in reversed(parts):
+                if len(part) > 1:
+                    stack.append((part, k + 1))
+                else:
+                    self.stats[stage[0] + '_settled'] += 1
+                    del sessions[part[0]]
+        return ans
+
+    def resolve(self, names):
+        """
+        Returns the isometry classes that were settled and those left
+        unresolved.  The former is a list of classes, each isometric
+        within and distinguished by invariants from everything else;
+        the latter a list of lists of classes that no invariant could
+        tell apart but weren't shown to be isometric.
+        """
+        colliding = self.split(names)
+        in_collision = set(sum(colliding, []))
+        settled = [[name] for name in names if name not in in_collision]
+        unresolved = []
+        for group in colliding:
+            classes = []
+            for name in group:
+                for C in classes:
+                    if weed.isometry_verdict(C[0], name):
+                        C.append(name)
+                        break
+                else:
+                    classes.append([name])
+            if len(classes) == 1:
+                settled += classes
+                self.stats['isometry_settled'] += 1
+            else:
+                unresolved.append(classes)
+        return settled, unresolved
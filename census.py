@@ -0,0 +1,80 @@
+"""
+Looking up closed manifolds in our census, in the manner of SnapPy's
+census.identify.
+"""
+
+import bisect
+import snappy
+import pandas as pd
+
+def chern_simons_match(a, b, tol=1e-6):
+    """
+    Whether Chern-Simons invariants a and b, which are defined mod
+    1/2, could belong to the same unoriented manifold.
+
+    >>> chern_simons_match(0.2, -0.2), chern_simons_match(0.2, 0.3)
+    (True, True)
+    >>> chern_simons_match(0.2, 0.15)
+    False
+    """
+    for x in [a - b, a + b]:
+        r = x % 0.5
+        if min(r, 0.5 - r) < tol:
+            return True
+    return False
+
+class ClosedCensus:
+    """
+    A table of closed manifolds with columns 'name', 'volume' and,
+    optionally, 'chern_simons', sorted by volume so that the
+    candidates for a given manifold are found by bisection.  The
+    Chern-Simons invariant, when known on both sides, narrows them
+    down before any isometry checks.
+
+    >>> C = ClosedCensus(pd.DataFrame({'name':['A', 'B', 'C'],
+    ...        'volume':[2.0, 1.0, 2.0], 'chern_simons':[0.2, 0.1, -0.2]}))
+    >>> C.candidates(2.0, 0.2), C.candidates(2.0, 0.15), C.candidates(1.0)
+    (['A', 'C'], [], ['B'])
+    """
+    def __init__(self, table=None, vol_tol=1e-6, cs_tol=1e-6):
+        if table is None:
+            table = pd.read_csv('closed.csv.bz2')
+        table = table.sort_values('volume', kind='mergesort')
+        self.names = list(table['name'])
+        self.volumes = list(table['volume'])
+        if 'chern_simons' in table:
+            self.chern_simons = list(table['chern_simons'])
+        else:
+            self.chern_simons = [None]*len(self.names)
+        self.vol_tol, self.cs_tol = vol_tol, cs_tol
+
+    def candidates(self, volume, chern_simons=None):
+        lo = bisect.bisect_left(self.volumes, volume - self.vol_tol)
+        hi = bisect.bisect_right(self.volumes, volume + self.vol_tol)
+        ans = []
+        for i in range(lo, hi):
+            cs = self.chern_simons[i]
+            if (chern_simons is None or cs is None or pd.isnull(cs) or
+                chern_simons_match(cs, chern_simons, self.cs_tol)):
+                ans.append(self.names[i])
+        return ans
+
+    def identify(self, manifold, confirm=True):
+        """
+        The name of the census manifold isometric to the given one, or
+        None.  With confirm=False, a unique candidate is accepted
+        without checking the isometry.
+        """
+        try:
+            cs = float(manifold.chern_simons())
+        except (ValueError, RuntimeError):
+            cs = None
+        names = self.candidates(float(manifold.volume()), cs)
+        if len(names) == 1 and not confirm:
+            return names[0]
+        for name in names:
+            try:
+                if snappy.Manifold(name).is_isometric_to(manifold):
+                    return name
+            except RuntimeError:
+                pass
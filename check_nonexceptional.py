@@ -6,6 +6,7 @@ are hyperbolic.
 This file was originally in the repository "closed_census".
 """
 
+import os, multiprocessing
 import snappy
 from sage.all import RealIntervalField, FreeModule, gcd, ZZ
 
@@ -63,27 +64,86 @@ def find_positive_triangulation(manifold, tries=100):
                 return X
             M.randomize()
 
-def verify_hyperbolic_basic(manifold):
+def integer_fillings(manifold):
+    return [tuple(int(round(x)) for x in f) for f in manifold.cusp_info('filling')]
+
+def certificate_key(manifold):
+    """
+    The key for certificate stores, e.g. 'm004(1, 2)'.
+    """
+    return manifold.name() + ''.join(repr(f) for f in integer_fillings(manifold))
+
+def basic_certificate(manifold):
+    """
+    Proves the manifold hyperbolic as in verify_hyperbolic_basic and
+    returns a certificate, or None on failure.  The certificate is a
+    dict giving the decorated isosig and Dehn fillings of the
+    triangulation that worked and the precision at which it did.
+    """
     M = find_positive_triangulation(manifold)
     if M is not None:
         prec = 53
         while prec < 1000:
             try:
                 if M.verify_hyperbolicity(bits_prec=prec)[0]:
-                    return True
+                    return {'isosig':M.triangulation_isosig(decorated=True),
+                            'filling':integer_fillings(M), 'bits_prec':prec}
             except RuntimeError:
                 print('Treating exception in verify code as a failure')
-            prec = 2*prec                
-    return False
+            prec = 2*prec
+
+def verify_hyperbolic_basic(manifold):
+    return basic_certificate(manifold) is not None
+
+def hyperbolicity_certificate(manifold):
+    """
+    The certificate from basic_certificate, trying covers of degree at
+    most 6 if the manifold itself fails, in which case 'cover' records
+    the degree and position in manifold.covers(degree) of the cover
+    that was proven hyperbolic.
+    """
+    cert = basic_certificate(manifold)
+    if cert is not None:
+        return cert
+    for d in range(1, 7):
+        for i, C in enumerate(manifold.covers(d)):
+            cert = basic_certificate(C)
+            if cert is not None:
+                cert['cover'] = (d, i)
+                return cert
 
-def is_hyperbolic(manifold):
-    if verify_hyperbolic_basic(manifold):
+def check_certificate(certificate):
+    """
+    Redoes the proof recorded in the certificate with a single call to
+    verify_hyperbolicity.  For covers, this proves the recorded cover
+    hyperbolic; that it covers the original manifold is taken from
+    the certificate.
+    """
+    M = snappy.Manifold(certificate['isosig'])
+    M.dehn_fill(certificate['filling'])
+    try:
+        return bool(M.verify_hyperbolicity(bits_prec=certificate['bits_prec'])[0])
+    except RuntimeError:
+        return False
+
+def is_hyperbolic(manifold, certificates=None):
+    """
+    Returns True if the manifold is proven hyperbolic.  If given,
+    certificates is a dict, or anything with the same get and item
+    assignment, keyed by certificate_key.  A certificate found there is rechecked
+    instead of searching afresh, and new certificates are saved to
+    it.
+    """
+    if certificates is not None:
+        key = certificate_key(manifold)
+        cert = certificates.get(key)
+        if cert is not None and check_certificate(cert):
+            return True
+    cert = hyperbolicity_certificate(manifold)
+    if cert is not None:
+        if certificates is not None:
+            certificates[key] = cert
         return True
-    else:
-        for d in range(1, 7):
-            for C in manifold.covers(d):
-                if verify_hyperbolic_basic(C):
-                    return True
 
                 
 def cusp_translations(manifold):
@@ -116,12 +176,98 @@ def slopes_to_length_six(manifold):
     return [tuple(s) for (r, s) in slopes_by_length if not(r > six)]
 
 
-def check_manifold(manifold, excluded_slopes):
+def read_checkpoint(path):
+    """
+    The slopes saved by check_slopes in the checkpoint file at path,
+    as a dict from slope to True, after removing any partial last line
+    left by a crash.  Failures are left out so that they are retried.
+    """
+    if path is None or not os.path.exists(path):
+        return dict()
+    text = open(path).read()
+    complete = text[:text.rfind('\n') + 1]
+    if complete != text:
+        with open(path, 'w') as file:
+            file.write(complete)
+    verdicts = [eval(line) for line in complete.splitlines()]
+    return dict((s, True) for s, verdict in verdicts if verdict)
+
+def _check_slope(job):
+    # Runs in a worker, so the certificate store stays in the parent.
+    isosig, name, slope, cert = job
+    M = snappy.Manifold(isosig)
+    M.set_name(name)
+    M.dehn_fill(slope)
+    if cert is not None and check_certificate(cert):
+        return slope, cert
+    return slope, hyperbolicity_certificate(M)
+
+def check_slopes(manifold, excluded_slopes, mode='abort', processes=1,
+                 checkpoint=None, certificates=None):
+    """
+    Tries to prove hyperbolic the filling along each slope of
+    slopes_to_length_six not in excluded_slopes, returning a dict from
+    slope to verdict.  With mode='abort', it stops at the first
+    failure, so only the verdicts found by then are returned; with
+    mode='full', every slope is tried.
+
+    The slopes are spread over 'processes' worker processes.  If
+    checkpoint is a path, each success is appended to that file and
+    synced to disk as soon as it is known, and a rerun only does the
+    slopes not already there.  The optional certificates are as in
+    is_hyperbolic.
+    """
+    assert mode in ['abort', 'full']
+    M = manifold
+    slopes = [tuple(int(x) for x in s) for s in slopes_to_length_six(M)]
+    slopes = [s for s in slopes if s not in excluded_slopes]
+    saved = read_checkpoint(checkpoint)
+    verdicts = dict((s, True) for s in slopes if s in saved)
+    isosig = M.triangulation_isosig(decorated=True)
+    jobs, keys = [], dict()
+    for s in slopes:
+        if s not in verdicts:
+            cert = None
+            if certificates is not None:
+                keys[s] = M.name() + repr(s)
+                cert = certificates.get(keys[s])
+            jobs.append((isosig, M.name(), s, cert))
+
+    file = open(checkpoint, 'a') if checkpoint is not None else None
+    if processes == 1:
+        results = (_check_slope(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_check_slope, jobs)
+    try:
+        for s, cert in results:
+            verdicts[s] = cert is not None
+            if cert is not None and certificates is not None:
+                certificates[keys[s]] = cert
+            if file is not None and verdicts[s]:
+                file.write(repr((s, verdicts[s])) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            if mode == 'abort' and not verdicts[s]:
+                break
+    finally:
+        if processes > 1:
+            pool.terminate()
+            pool.join()
+        if file is not None:
+            file.close()
+    return verdicts
+
+def check_manifold(manifold, excluded_slopes, certificates=None,
+                   processes=1, checkpoint=None):
     """ 
 
     When this function returns True, it means that it proved that
     *every* slope not in excluded_slopes is hyperbolic.  It does not
     check in any way that the excluded_slopes are nonhyperbolic.
+    The optional certificates are as in is_hyperbolic, so that a
+    rerun only has to recheck them.  The processes and checkpoint are
+    as in check_slopes, which stops at the first failure.
 
     >>> M = snappy.Manifold('o9_44223')
     >>> check_manifold(M, [])
@@ -134,16 +280,12 @@ def check_manifold(manifold, excluded_slopes):
     >>> M = snappy.Manifold('t05185')
     >>> check_manifold(M, [(-1, 1), (0, 1), (1, 0), (1, 1)])
     True
+    >>> check_manifold(M, [(-1, 1), (0, 1), (1, 0), (1, 1)], processes=2)
+    True
     """
-    M = manifold
-    slopes = []
-    for s in slopes_to_length_six(M):
-        if s not in excluded_slopes:
-            N = M.copy()
-            N.dehn_fill(s)
-            if not is_hyperbolic(N):
-                return False
-    return True
+    verdicts = check_slopes(manifold, excluded_slopes, 'abort', processes,
+                            checkpoint, certificates)
+    return all(verdicts.values())
 
 # Code past this point was used for the actual computations which
 # involved storing the contents of "cusped_with_exceptional.csv.bz2"
@@ -169,19 +311,20 @@ def add_slope_length(task):
     task['slope_length'] = float(r)
     task['done'] = True
 
+# For check_manifold_saving_details: the number of processes per
+# manifold and, if not None, the directory for its checkpoint files.
+slope_processes = 1
+checkpoint_dir = None
+
 def check_manifold_saving_details(task):
     M = snappy.Manifold(task['name'])
     excluded = eval(task['exceptional_slopes'])
-    hyp_slopes = []
-    failure = False
-    for s in slopes_to_length_six(M):
-        if s not in excluded:
-            N = M.copy()
-            N.dehn_fill(s)
-            if is_hyperbolic(N):
-                hyp_slopes.append(s)
-            else:
-                failure = True
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = os.path.join(checkpoint_dir, task['name'] + '.txt')
+    verdicts = check_slopes(M, excluded, 'full', slope_processes, checkpoint)
+    hyp_slopes = [s for s in slopes_to_length_six(M) if verdicts.get(s)]
+    failure = not all(verdicts.values())
                 
     task['hyperbolic_slopes'] = repr(hyp_slopes)
     task['passed'] = 0 if failure else 1
@@ -8,17 +8,21 @@
 #SBATCH --output=slurm_out/%j
 #SBATCH --error=slurm_error/%j
 
-import taskdb2, snappy, dehn
+import taskdb2, snappy, dehn, screen, symmetry
 
 def create_database():
-    names = [M.name() for M in snappy.OrientableCuspedCensus(cusps=1)]
-    cols = [('finite', 'text'), ('inj_02', 'text')]
+    names = dehn.census_names()
+    cols = [('finite', 'text'), ('inj_02', 'text'), ('inj_02_cutoff', 'text'),
+            ('screen', 'text')]
     taskdb2.ExampleDatabase('cusped_fillings', names, cols)
     
 def find_fat_fillings(task):
-    M = snappy.ManifoldHP(task['name'])
-    slopes = dehn.hyperbolic_dehn_fillings(M, 0.2)
+    M = snappy.Manifold(task['name'])
+    S = screen.TwoTierScreen(M)
+    slopes = S.fat_fillings(0.2, symmetry.SlopeOrbits(M))
     task['inj_02'] = repr(sorted(slopes))
+    task['inj_02_cutoff'] = repr(dehn.slope_cutoff(0.2))
+    task['screen'] = repr(dict(S.stats))
     task['done'] = True
 
 exdb = taskdb2.ExampleDatabase('cusped_fillings')
@@ -2,19 +2,27 @@
 #
 #SBATCH --partition m
 #SBATCH --tasks=1
+#SBATCH --cpus-per-task=4
 #SBATCH --mem-per-cpu=4096
 #SBATCH --nice=10000
 #SBATCH --time=7-00:00
 #SBATCH --output=slurm_out/%j
 #SBATCH --error=slurm_error/%j
-#SBATCH --nodelist=keeling-e01
 
-import taskdb2, snappy, finite
+import os, collections
+import taskdb2, snappy, finite, store, symmetry
+
+cache = store.ReprStore('finite_cache.sqlite')
+processes = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
 
 def find_finite_fillings(task):
     M = snappy.ManifoldHP(task['name'])
-    slopes = finite.finite_fillings(M)
+    stats = collections.Counter()
+    slopes = finite.finite_fillings(M, cache, engine='local', stats=stats,
+                                    orbits=symmetry.SlopeOrbits(M),
+                                    processes=processes, seconds=120)
     task['finite'] = repr(sorted(slopes))
+    task['finite_stages'] = repr(dict(stats))
     task['done'] = True
 
 exdb = taskdb2.ExampleDatabase('cusped_fillings')
@@ -14,6 +14,14 @@
 #exdb.run_function('task_basic', hyperbolic.basic_invariants_cusped)
 #exdb.run_function('task_inj', hyperbolic.add_injectivity_cusped)
 
-import taskdb2.worker, hyperbolic
+import os
+import taskdb2.worker, hyperbolic, session
 
-taskdb2.worker.run_function('closed_02', 'task_fix_CS', hyperbolic.recompute_chern_simons)
+#taskdb2.worker.run_function('closed_02', 'task_fix_CS', hyperbolic.recompute_chern_simons)
+#taskdb2.worker.run_function('closed_02', 'task_invariants', session.add_invariants)
+
+# Submit as a job array, e.g. sbatch --array=0-99, so each job takes
+# every filling of its share of the bases.
+session.sweep_by_base('closed_02', ['volume', 'chern_simons', 'verified', 'verify_timings'],
+                      int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)),
+                      int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1)))
@@ -0,0 +1,253 @@
+"""
+Todd-Coxeter coset enumeration over the trivial subgroup, so that
+finite fundamental groups can be detected without Magma.
+
+This is the HLT strategy from Section 5.1 of Holt's "Handbook of
+Computational Group Theory", with a coset table that is compacted
+whenever it fills up, followed by a lookahead pass if that doesn't
+free enough room.  The table is a flat list, with the entry for coset
+c and column x at c*num_cols + x, as the scans read it one entry at a
+time and plain lists are much faster at that than NumPy arrays.
+"""
+
+def parse_word(word, num_gens):
+    """
+    SnapPy writes generators as lowercase letters and their inverses
+    as uppercase.  Generator i becomes column 2*i and its inverse
+    column 2*i + 1.
+
+    >>> parse_word('abA', 2)
+    [0, 2, 1]
+    """
+    ans = []
+    for c in word:
+        i = ord(c.lower()) - ord('a')
+        assert 0 <= i < num_gens
+        ans.append(2*i + (0 if c.islower() else 1))
+    return ans
+
+def free_reduce(word):
+    ans = []
+    for x in word:
+        if ans and ans[-1] == x ^ 1:
+            ans.pop()
+        else:
+            ans.append(x)
+    while len(ans) > 1 and ans[0] == ans[-1] ^ 1:
+        ans = ans[1:-1]
+    return ans
+
+class CosetLimitExceeded(Exception):
+    pass
+
+class CosetTable:
+    """
+    A coset table for the action of G = < gens | relators > on the
+    cosets of the trivial subgroup.  Entries are -1 when undefined.
+    Cosets are only renumbered between the processing of one coset and
+    the next, so that enough room is left to process any coset
+    without running out.
+
+    >>> T = CosetTable(2, ['aa', 'bbb', 'abab'])
+    >>> T.enumerate()
+    6
+    """
+    def __init__(self, num_gens, relators, coset_limit=250000):
+        self.num_gens, self.num_cols = num_gens, 2*num_gens
+        rels = [free_reduce(parse_word(R, num_gens)) for R in relators]
+        self.relators = [R for R in rels if R]
+        self.headroom = sum(len(R) for R in self.relators) + self.num_cols
+        self.limit = coset_limit
+        self.max_size = coset_limit + self.headroom
+        self.size = min(self.max_size, 1024 + self.headroom)
+        self.table = [-1]*(self.size*self.num_cols)
+        self.parent = list(range(self.size))
+        self.next = 1  # Coset 0 is the trivial subgroup itself.
+
+    def entry(self, c, x):
+        return self.table[c*self.num_cols + x]
+
+    def rep(self, c):
+        p = self.parent
+        r = c
+        while p[r] != r:
+            r = p[r]
+        while p[c] != r:
+            p[c], c = r, p[c]
+        return r
+
+    def live(self, c):
+        return self.parent[c] == c
+
+    def num_live(self):
+        p = self.parent
+        return sum(1 for c in range(self.next) if p[c] == c)
+
+    def define(self, c, x):
+        d = self.next
+        self.next += 1
+        k = self.num_cols
+        self.table[c*k + x] = d
+        self.table[d*k + (x ^ 1)] = c
+
+    def scan_and_fill(self, c, word, define=True):
+        T, k = self.table, self.num_cols
+        f, b = c, c
+        i, j = 0, len(word) - 1
+        while True:
+            while i <= j and T[f*k + word[i]] >= 0:
+                f = T[f*k + word[i]]
+                i += 1
+            if i > j:
+                if f != b:
+                    self.coincidence(f, b)
+                return
+            while j >= i and T[b*k + (word[j] ^ 1)] >= 0:
+                b = T[b*k + (word[j] ^ 1)]
+                j -= 1
+            if j < i:
+                self.coincidence(f, b)
+                return
+            elif i == j:
+                T[f*k + word[i]] = b
+                T[b*k + (word[i] ^ 1)] = f
+                return
+            elif define:
+                self.define(f, word[i])
+            else:
+                return
+
+    def lookahead(self):
+        """
+        Scan every relator at every coset without making definitions,
+        which often uncovers coincidences that free up most of the
+        table.
+        """
+        for c in range(self.next):
+            for R in self.relators:
+                if not self.live(c):
+                    break
+                self.scan_and_fill(c, R, define=False)
+
+    def _merge(self, k, l, queue):
+        k, l = self.rep(k), self.rep(l)
+        if k != l:
+            k, l = min(k, l), max(k, l)
+            self.parent[l] = k
+            queue.append(l)
+
+    def coincidence(self, a, b):
+        T, k = self.table, self.num_cols
+        queue = []
+        self._merge(a, b, queue)
+        i = 0
+        while i < len(queue):
+            e = queue[i]
+            i += 1
+            for x in range(k):
+                f = T[e*k + x]
+                if f >= 0:
+                    T[f*k + (x ^ 1)] = -1
+                    e1, f1 = self.rep(e), self.rep(f)
+                    if T[e1*k + x] >= 0:
+                        self._merge(f1, T[e1*k + x], queue)
+                    elif T[f1*k + (x ^ 1)] >= 0:
+                        self._merge(e1, T[f1*k + (x ^ 1)], queue)
+                    else:
+                        T[e1*k + x] = f1
+                        T[f1*k + (x ^ 1)] = e1
+
+    def compact(self):
+        """
+        Renumber the live cosets as 0, 1, ... preserving their order,
+        returning the list giving the new numbers.
+        """
+        n, k = self.next, self.num_cols
+        T, p = self.table, self.parent
+        new_index, count = [], 0
+        for c in range(n):
+            new_index.append(count if p[c] == c else -1)
+            count += p[c] == c
+        # New numbers are never larger, so rows can move down in place.
+        for c in range(n):
+            d = new_index[c]
+            if d >= 0:
+                row = T[c*k:(c + 1)*k]
+                T[d*k:(d + 1)*k] = [new_index[e] if e >= 0 else -1 for e in row]
+        T[count*k:n*k] = [-1]*((n - count)*k)
+        self.parent = list(range(self.size))
+        self.next = count
+        return new_index
+
+    def _make_room(self, c):
+        # Ensures processing coset c can't overflow the table,
+        # returning the possibly new number of c.
+        if self.next + self.headroom <= self.size:
+            return c
+        if self.size < self.max_size:
+            new = min(2*self.size, self.max_size)
+            self.table.extend([-1]*((new - self.size)*self.num_cols))
+            self.parent.extend(range(self.size, new))
+            self.size = new
+            return self._make_room(c)
+        c = self.compact()[c]
+        if self.next + self.headroom > self.size:
+            self.lookahead()
+            # If c itself died, carry on from the next live coset.
+            while c < self.next and not self.live(c):
+                c += 1
+            c = self.compact()[c] if c < self.next else self.next
+            if self.next + self.headroom > self.size:
+                raise CosetLimitExceeded
+        return c
+
+    def enumerate(self):
+        """
+        Returns the index of the trivial subgroup, that is, the order
+        of the group.  Raises CosetLimitExceeded if more than about
+        coset_limit cosets are needed at once.
+        """
+        c = 0
+        while c < self.next:
+            if self.live(c):
+                c = self._make_room(c)
+                if c == self.next:
+                    break
+                for R in self.relators:
+                    self.scan_and_fill(c, R)
+                    if not self.live(c):
+                        break
+                if self.live(c):
+                    for x in range(self.num_cols):
+                        if self.entry(c, x) < 0:
+                            self.define(c, x)
+            c += 1
+        return self.num_live()
+
+def order(group, coset_limit=250000):
+    """
+    The order of a SnapPy fundamental group when coset enumeration
+    finishes within coset_limit cosets, and None otherwise, so it
+    cannot tell infinite groups from ones that are merely hard.
+
+    Typical use is via a stand-in with the same two methods.
+
+    >>> class Pres:
+    ...     def __init__(self, n, rels): self.n, self.rels = n, rels
+    ...     def num_generators(self): return self.n
+    ...     def relators(self): return self.rels
+    >>> order(Pres(2, ['aaa', 'bb', 'abab']))
+    6
+    >>> order(Pres(2, ['aaaa', 'bbb', 'abab']))
+    24
+    >>> order(Pres(2, ['aa', 'bbb', 'ab'*7]), coset_limit=1000)
+    >>> order(Pres(1, ['aaaaa']))
+    5
+    """
+    if group.num_generators() == 0:
+        return 1
+    T = CosetTable(group.num_generators(), group.relators(), coset_limit)
+    try:
+        return T.enumerate()
+    except CosetLimitExceeded:
+        return None
@@ -2,17 +2,32 @@
 Dehn fillings of 1-cusped hyperbolic 3-manifolds.
 """
 
+import os, csv, time, collections, multiprocessing
 from sage.all import (gcd, vector, matrix, sqrt,
                       ComplexField, RealField, FreeModule,
                       ZZ) 
+import numpy
 import snappy
-import hyperbolic
+import hyperbolic, symmetry
 
 ZZ2 = FreeModule(ZZ, 2)
 
 def dehn_filling_filter(a, b):
     return gcd(a,b) == 1 and not (a == 0 and b < 0) and not (a < 0 and b == 0)
 
+normalize_slope = symmetry.normalize_slope
+
+def filling_name(manifold):
+    """
+    The name used in our tables for a Dehn filling on a 1-cusped
+    manifold.
+
+    >>> filling_name(snappy.Manifold('m003(-1, 1)'))
+    'm003(-1, 1)'
+    """
+    slope = tuple(int(round(x)) for x in manifold.cusp_info(0).filling)
+    return manifold.name() + repr(slope)
+
 def half_square(n, primitive=False):
     """
     All lattice points on the square of 'radius' n
@@ -29,6 +44,23 @@ def half_filled_square(n, primitive=False):
         ans += half_square(i, primitive)
     return ans
 
+def square_position(p):
+    """
+    Where the lattice point p appears in the enumeration of
+    half_filled_square.
+
+    >>> [square_position(p) for p in half_square(1)]
+    [(1, 0), (1, 1), (1, 2), (1, 3), (1, 4)]
+    """
+    x, y = p
+    n = max(abs(x), y)
+    if x == -n and y < n:
+        return (n, y)
+    elif y == n and x < n:
+        return (n, n + n + x)
+    else:
+        return (n, 3*n + y)
+
 class NormalizedCuspLattice:
     """
     The Euclidean cusp lattice of a 1-cusped hyperbolic 3-manifold,
@@ -55,12 +87,28 @@ class NormalizedCuspLattice:
     def norm(self, v):
         return sqrt(v * self.gram * v)
 
-    def primitive_elements(self, max_length=7.6):
+    def primitive_elements(self, max_length=7.6, method='ellipse'):
         """
         Default max_length ensures that for any longer slope the filling
         is hyperbolic with core geodesic *shorter* than 0.17.  See
         Remark 5.8 on page 410 of Hodgson-Kerckhoff for details.
+
+        The default method walks the ellipse of the quadratic form one
+        row at a time using floating point, only falling back on exact
+        norms near the cutoff and when sorting near-ties; the method
+        'squares' is the original enumeration, kept as a check.
+
+        >>> M = snappy.Manifold('m004')
+        >>> L = NormalizedCuspLattice(M)
+        >>> L.primitive_elements(method='squares') == L.primitive_elements()
+        True
         """
+        if method == 'squares':
+            return self._primitive_elements_squares(max_length)
+        assert method == 'ellipse'
+        return self._primitive_elements_ellipse(max_length)
+
+    def _primitive_elements_squares(self, max_length):
         # To find all slopes up to the specified length, we need to
         # know how much shorter a vector can be in the cusp lattice as
         # compared to the norm of the corresponding vector in Z^2.  As
@@ -80,6 +128,53 @@ class NormalizedCuspLattice:
         ans.sort(key=self.norm)
         return ans
 
+    def _primitive_elements_ellipse(self, max_length, rel_tol=1e-9):
+        # The slope (p, q) has squared length a p^2 + 2 b p q + c q^2,
+        # so for each q >= 0 the allowed p form an interval; the
+        # q-range is bounded by a R^2/det(G), where R = max_length.
+        g = self.gram
+        a, b, c = [float(g[i, j].real()) for i, j in [(0, 0), (0, 1), (1, 1)]]
+        det = a*c - b*b
+        R2 = float(max_length)**2
+        lower, upper = R2*(1 - rel_tol), R2*(1 + rel_tol)
+        pts, norms2 = [], []
+        q_max = int(numpy.floor(numpy.sqrt(a*upper/det)))
+        for q in range(0, q_max + 1):
+            disc = max(b*b*q*q - a*(c*q*q - upper), 0.0)
+            lo = int(numpy.floor((-b*q - numpy.sqrt(disc))/a)) - 1
+            hi = int(numpy.ceil((-b*q + numpy.sqrt(disc))/a)) + 1
+            p = numpy.arange(lo, hi + 1, dtype=numpy.int64)
+            if q == 0:
+                p = p[p == 1]
+            else:
+                p = p[numpy.gcd(p, q) == 1]
+            n2 = (a*p + 2*b*q)*p + c*q*q
+            row = n2 <= upper
+            p, n2 = p[row], n2[row]
+            ok = n2 <= lower
+            for i in numpy.nonzero(~ok)[0]:
+                ok[i] = self.norm(ZZ2((int(p[i]), q))) <= max_length
+            pts += [(int(x), q) for x in p[ok]]
+            norms2 += list(n2[ok])
+        return [ZZ2(v) for v in self._sort_by_norm(pts, norms2, rel_tol)]
+
+    def _sort_by_norm(self, pts, norms2, rel_tol):
+        # Sort by the floating point norm, then redo any run of
+        # near-ties with the exact norm, breaking exact ties in the
+        # order that the 'squares' enumeration visits the points.
+        order = numpy.argsort(norms2, kind='stable')
+        pts = [pts[i] for i in order]
+        norms2 = numpy.asarray(norms2, dtype=float)[order]
+        ans, start = [], 0
+        for i in range(1, len(pts) + 1):
+            if i == len(pts) or norms2[i] > norms2[i - 1]*(1 + rel_tol):
+                run = pts[start:i]
+                if len(run) > 1:
+                    run.sort(key=lambda v:(self.norm(ZZ2(v)), square_position(v)))
+                ans += run
+                start = i
+        return ans
+
     def __repr__(self):
         return "<CuspLattice %s %s>" % (self.m, self.l)
 
@@ -97,6 +192,7 @@ def test_cusp_lattice_primitive_elements(num_tests=10):
         prim_elts1 = L.primitive_elements(5)
         prim_elts2 = [e for e in L.primitive_elements(10) if L.norm(e) <= 5]
         assert prim_elts1 == prim_elts2
+        assert prim_elts1 == L.primitive_elements(5, method='squares')
 
 def appears_hyperbolic(M):
     """
@@ -133,35 +229,248 @@ def approx_systole(M):
     d = M.dual_curves()[0]
     return min(c.real(), d['filled_length'].real())
 
-def hyperbolic_dehn_fillings(manifold, min_core_geod=0.2):
+def is_fat_filling(M, min_core_geod):
+    """
+    Whether the filled manifold M appears hyperbolic with both the
+    core geodesic and the shortest dual curve at least min_core_geod.
+    """
+    if appears_hyperbolic(M):
+        c = M.cusp_info(0).core_length
+        if c.real() >= min_core_geod:
+            d = M.dual_curves()[0]
+            if d['filled_length'].real() >= min_core_geod:
+                return True
+    return False
+
+# Pairs (L, ell) where every slope of normalized length at least L
+# gives a hyperbolic filling whose core geodesic is shorter than ell,
+# per Remark 5.8 on page 410 of Hodgson-Kerckhoff.  Their results say
+# nothing about slopes shorter than HK_MIN_LENGTH, as such fillings
+# need not even be hyperbolic, so no cutoff can be below it.
+
+HK_MIN_LENGTH = 7.5832
+HK_CORE_BOUNDS = [(7.6, 0.17)]
+
+def slope_cutoff(min_core_geod):
+    """
+    The pair (L, ell) from HK_CORE_BOUNDS with the smallest L such
+    that ell < min_core_geod.  Every filling along a slope longer
+    than L has core geodesic too short to matter, so only slopes up
+    to L need be examined.  The pair should be recorded with the
+    results, as closed_list_shard and run_dehn do.
+
+    >>> slope_cutoff(0.2)
+    (7.6, 0.17)
+    >>> slope_cutoff(0.1)
+    Traceback (most recent call last):
+    ...
+    ValueError: No Hodgson-Kerckhoff bound for core length 0.1
+    """
+    usable = [(L, ell) for L, ell in HK_CORE_BOUNDS
+              if ell < min_core_geod and L >= HK_MIN_LENGTH]
+    if len(usable) == 0:
+        raise ValueError('No Hodgson-Kerckhoff bound for core length %s' % min_core_geod)
+    return min(usable)
+
+def continuation_order(lattice, slopes):
+    """
+    Reorder the slopes so that consecutive ones are close in the cusp
+    lattice, starting with the longest as its filling is nearest to
+    the complete structure.  Greedy nearest neighbour, where s and -s
+    count as the same slope.
+
+    >>> L = NormalizedCuspLattice(snappy.Manifold('m004'))
+    >>> slopes = L.primitive_elements(3)
+    >>> sorted(continuation_order(L, slopes)) == sorted(slopes)
+    True
+    """
+    g = lattice.gram
+    a, b, c = [float(g[i, j].real()) for i, j in [(0, 0), (0, 1), (1, 1)]]
+    def dist2(s, t):
+        return min(a*x*x + 2*b*x*y + c*y*y
+                   for x, y in [(s[0] - t[0], s[1] - t[1]),
+                                (s[0] + t[0], s[1] + t[1])])
+
+    remaining = list(slopes)
+    if len(remaining) == 0:
+        return []
+    i = max(range(len(remaining)), key=lambda i:dist2(remaining[i], (0, 0)))
+    ans = [remaining.pop(i)]
+    while remaining:
+        i = min(range(len(remaining)), key=lambda i:dist2(remaining[i], ans[-1]))
+        ans.append(remaining.pop(i))
+    return ans
+
+def cold_fillings(manifold, slopes):
     """
+    Generates pairs (slope, M), each solved from the complete structure.
+    """
+    for s in slopes:
+        M = manifold.copy()
+        M.dehn_fill(s, 0)
+        yield s, M
+
+def fillings_by_continuation(manifold, slopes, stats=None):
+    """
+    Generates pairs (slope, M) where M is the manifold filled along
+    the slope.  Each Dehn filling starts the gluing equation solver
+    from the shapes of the previous filling, and any slope where that
+    doesn't appear hyperbolic is redone starting from the complete
+    structure.  The counts of each are recorded in the
+    collections.Counter stats, if given.
+
+    The M's share data, so copy any you want to keep.
+    """
+    if stats is None:
+        stats = collections.Counter()
+    M = manifold.copy()
+    for s in slopes:
+        M.dehn_fill(s, 0)
+        if appears_hyperbolic(M):
+            stats['warm'] += 1
+            yield s, M
+        else:
+            stats['cold'] += 1
+            N = manifold.copy()
+            N.dehn_fill(s, 0)
+            yield s, N
+            M = N if appears_hyperbolic(N) else manifold.copy()
+
+def hyperbolic_dehn_fillings(manifold, min_core_geod=0.2,
+                             continuation=False, stats=None, orbits=None):
+    """
+    Examines the slopes up to the length given by slope_cutoff.
+    With continuation=True, the slopes are visited via
+    continuation_order and solved by fillings_by_continuation; the
+    answer is the same, just faster.  Given orbits, a
+    symmetry.SlopeOrbits, only one slope per orbit is filled.
+
     >>> M = snappy.ManifoldHP('s000')
     >>> len(hyperbolic_dehn_fillings(M))
     16
+    >>> len(hyperbolic_dehn_fillings(M, continuation=True))
+    16
+    >>> len(hyperbolic_dehn_fillings(M, orbits=symmetry.SlopeOrbits(M)))
+    16
     """
-    assert min_core_geod > 0.17
+    max_length = slope_cutoff(min_core_geod)[0]
     L = NormalizedCuspLattice(manifold)
-    ans = []
-    for s in L.primitive_elements():
-        M = manifold.copy()
-        M.dehn_fill(s, 0)
-        if appears_hyperbolic(M):
-            c = M.cusp_info(0).core_length
-            if c.real() >= min_core_geod:
-                d = M.dual_curves()[0]
-                if d['filled_length'].real() >= min_core_geod:
-                    ans.append(s)
-    return ans
+    slopes = L.primitive_elements(max_length)
+    todo = slopes if orbits is None else orbits.representatives(slopes)
+    if continuation:
+        filled = fillings_by_continuation(manifold,
+                                          continuation_order(L, todo),
+                                          stats)
+    else:
+        filled = cold_fillings(manifold, todo)
+    fat = set()
+    for s, M in filled:
+        if is_fat_filling(M, min_core_geod):
+            fat.add(tuple(s))
+    fat = [s for s in todo if tuple(s) in fat]
+    return fat if orbits is None else orbits.spread(slopes, fat)
+
+def census_names(census=None, start=0, stop=None):
+    """
+    The names of the manifolds census[start:stop], by default for the
+    1-cusped part of OrientableCuspedCensus.  Only public SnapPy calls
+    are used, so each manifold is built in turn; pass the shard_range
+    to split the work.
 
-def initial_list_of_closed():
-    import csv
-    file = open('/pkgs/tmp/closed.csv', 'w')
+    >>> census_names(start=0, stop=3)
+    ['m003', 'm004', 'm006']
+    """
+    if census is None:
+        census = snappy.OrientableCuspedCensus(cusps=1)
+    if stop is None:
+        stop = len(census)
+    return [census[i].name() for i in range(start, stop)]
+
+def shard_range(size, shard, num_shards):
+    """
+    >>> [shard_range(10, k, 3) for k in range(3)]
+    [(0, 3), (3, 6), (6, 10)]
+    """
+    return (shard*size)//num_shards, ((shard + 1)*size)//num_shards
+
+def shard_path(directory, shard, num_shards):
+    return os.path.join(directory, 'closed_%03d_of_%03d.csv' % (shard, num_shards))
+
+def completed_rows(path):
+    """
+    The complete rows of a shard file, after removing any partial last
+    line left by a crash.
+    """
+    if not os.path.exists(path):
+        return []
+    text = open(path).read()
+    complete = text[:text.rfind('\n') + 1]
+    if complete != text:
+        with open(path, 'w') as file:
+            file.write(complete)
+    return list(csv.reader(complete.splitlines()))[1:]
+
+def closed_list_shard(shard, num_shards, directory, min_core_geod=0.2,
+                      checkpoint_seconds=5):
+    """
+    Find the fat fillings for one shard of the 1-cusped census, as
+    given by shard_range, streaming a row per manifold to its own CSV
+    file.  The file is synced to disk every checkpoint_seconds, and a
+    rerun resumes after the last manifold it contains.
+    """
+    census = snappy.OrientableCuspedCensus(cusps=1)
+    start, stop = shard_range(len(census), shard, num_shards)
+    path = shard_path(directory, shard, num_shards)
+    done = completed_rows(path)
+    if done:
+        start = int(done[-1][0]) + 1
+    file = open(path, 'a')
     writer = csv.writer(file)
-    writer.writerow(['name','slopes'])
-    for M in snappy.OrientableCuspedCensus(cusps=1):
-        slopes = hyperbolic_dehn_fillings(M)
-        writer.writerow([M.name(), repr(slopes)])
+    if not os.path.getsize(path):
+        writer.writerow(['index', 'name', 'slopes', 'cutoff'])
+    cutoff = repr(slope_cutoff(min_core_geod))
+    last_sync = time.time()
+    for i in range(start, stop):
+        M = census[i]
+        slopes = hyperbolic_dehn_fillings(M, min_core_geod, continuation=True,
+                                          orbits=symmetry.SlopeOrbits(M))
+        writer.writerow([i, M.name(), repr(slopes), cutoff])
         file.flush()
+        if time.time() - last_sync > checkpoint_seconds:
+            os.fsync(file.fileno())
+            last_sync = time.time()
+    os.fsync(file.fileno())
+    file.close()
+
+def _closed_list_shard(args):
+    return closed_list_shard(*args)
+
+def initial_list_of_closed(directory='/pkgs/tmp', num_shards=None, processes=None):
+    """
+    Run closed_list_shard on all shards using a pool of processes,
+    by default one per core with four shards each so that slow shards
+    don't hold things up, then collect the results into closed.csv.
+    Rerunning after a crash picks up where each shard left off.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if num_shards is None:
+        num_shards = 4*processes
+    pool = multiprocessing.Pool(processes)
+    pool.map(_closed_list_shard,
+             [(k, num_shards, directory) for k in range(num_shards)], chunksize=1)
+    pool.close()
+    pool.join()
+    merge_closed_shards(directory, num_shards)
+
+def merge_closed_shards(directory, num_shards):
+    file = open(os.path.join(directory, 'closed.csv'), 'w')
+    writer = csv.writer(file)
+    writer.writerow(['name','slopes', 'cutoff'])
+    for k in range(num_shards):
+        for row in completed_rows(shard_path(directory, k, num_shards)):
+            writer.writerow(row[1:])
+    file.close()
 
 if __name__ == "__main__":
     import doctest
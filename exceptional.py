@@ -10,32 +10,30 @@
 
 import taskdb2
 import snappy
-import dehn, hyperbolic
+import dehn, hyperbolic, screen, store, symmetry
 
-def solution_valid(M):
-    try: 
-        M.tetrahedra_shapes(bits_prec=212)
-        return True
-    except ValueError:
-        return False
+certificates = store.ReprStore('hyperbolic_certificates.sqlite')
 
 def remaining_exceptional(task):
-    manifold = snappy.ManifoldHP(task['name'])
+    """
+    Only one slope per symmetry orbit among the unknown ones is
+    checked.
+    """
+    manifold = snappy.Manifold(task['name'])
+    S = screen.TwoTierScreen(manifold)
     known = eval(task['fillings'])
     for slope in eval(task['other_exceptional']):
         known[slope] = 'other_exceptional'
-    L = dehn.NormalizedCuspLattice(manifold)
+    max_length = dehn.slope_cutoff(0.2)[0]
+    unknown = [s for s in S.slopes(max_length) if tuple(s) not in known]
+    orbits = symmetry.SlopeOrbits(manifold)
     ans = []
-    for s in L.primitive_elements():
-        if tuple(s) not in known:
-            proved_hyperbolic = False
-            M = manifold.copy()
-            M.dehn_fill(s, 0)
-            if not (dehn.appears_hyperbolic(M) and
-                    solution_valid(M) and
-                    hyperbolic.is_hyperbolic(M)):
-                ans.append(s)
-    task['new_exceptional'] = repr(ans)
+    for s in orbits.representatives(unknown):
+        M = S.hyperbolic_candidate(s)
+        if M is None or not hyperbolic.is_hyperbolic(M, certificates):
+            ans.append(s)
+    task['new_exceptional'] = repr(orbits.spread(unknown, ans))
+    task['screen'] = repr(dict(S.stats))
     task['done'] = True
 
 task0 = {'name':'o9_39593', 'fillings':'dict()', 'other_exceptional':'dict()'}
@@ -5,8 +5,10 @@ list.
 For simplicity (and hence robustness), we ignore the cusp neighborhood and search the below fixed list of slopes.  
 """
 
+import time, collections, multiprocessing
 import snappy
 import sage.all
+import dehn, coset, magma_pool, symmetry
 
 fixed_slopes = [(-1, 1), (0, 1), (1, 0), (1, 1), (-2, 1), (-1, 2), (1, 2), (2, 1),
           (-3, 1), (-3, 2), (-2, 3), (-1, 3), (1, 3), (2, 3), (3, 1), (3, 2)]
@@ -14,47 +16,278 @@ fixed_slopes = [(-1, 1), (0, 1), (1, 0), (1, 1), (-2, 1), (-1, 2), (1, 2), (2, 1
 def score_presentation(group):
     return group.num_generators(), sum(len(R) for R in group.relators())
     
-def good_presentation(manifold, tries=10):
-    M = manifold.copy()
-    best_G = M.fundamental_group()
-    best_score = score_presentation(best_G)
+# Variants of SnapPy's presentation simplification that the search can
+# try on each triangulation; by default only the first is, as each
+# variant costs a full simplification.
+presentation_moves = [dict(),
+                      dict(fillings_may_affect_generators=False),
+                      dict(minimize_number_of_generators=False),
+                      dict(try_hard_to_shorten_relators=False)]
+
+def rebuild_presentation(record):
+    """
+    Recreate the presentation found by presentation_search from its
+    record, without searching again.
+    """
+    T = snappy.Triangulation(record['isosig'])
+    T.dehn_fill(record['filling'])
+    return T.fundamental_group(**record['flags'])
+
+_found = None
+
+def _init_search(found):
+    global _found
+    _found = found
+
+def _search(args):
+    # Randomize the triangulation up to 'tries' times, scoring each via
+    # the triangulation rebuilt from its decorated isosig so that the
+    # winner can be reproduced exactly by rebuild_presentation.
+    isosig, filling, tries, deadline, worker, moves = args
+    T = snappy.Triangulation(isosig)
+    T.dehn_fill(filling)
+    best = None
     for i in range(tries):
-        if best_score[0] <= 1:
+        # Only worker 0 scores the triangulation as given.
+        if i > 0 or worker > 0:
+            T.randomize()
+        record = {'isosig':T.triangulation_isosig(decorated=True),
+                  'filling':filling, 'seed':(worker, i)}
+        for flags in moves:
+            record['flags'] = flags
+            score = score_presentation(rebuild_presentation(record))
+            if best is None or score < best['score']:
+                best = dict(record, score=score)
+        if best['score'][0] <= 1 and _found is not None:
+            _found.set()
+        if (best['score'][0] <= 1 or time.time() > deadline or
+            (_found is not None and _found.is_set())):
             break
-        M.randomize()
-        G = M.fundamental_group()
-        score = score_presentation(G)
-        if score < best_score:
-            best_score, best_G = score, G
-    return best_G
-
-def order_via_magma(group):
+    return best
+
+def presentation_search(manifold, tries=10, processes=1, seconds=None, moves=None):
+    """
+    Look for a presentation with few generators and short relators by
+    randomizing the triangulation, splitting the budget of tries
+    among the given number of worker processes and stopping everyone
+    once a 1-generator presentation turns up or the time runs out.
+    Each triangulation is simplified with each of the flags in moves,
+    by default just SnapPy's defaults; pass presentation_moves to try
+    all the variants.
+
+    Returns the group and a record of the winner, including its
+    (generators, relator length) score; the "seed" is the worker and
+    try that found it, as SnapPy's randomize can't be seeded, and the
+    record has everything rebuild_presentation needs.
+    """
+    if moves is None:
+        moves = presentation_moves[:1]
+    isosig = manifold.triangulation_isosig(decorated=True)
+    filling = [tuple(f) for f in manifold.cusp_info('filling')]
+    deadline = time.time() + seconds if seconds is not None else float('inf')
+    per_worker = -(-(tries + 1)//processes)
+    jobs = [(isosig, filling, per_worker, deadline, k, moves) for k in range(processes)]
+    if processes == 1:
+        results = [_search(jobs[0])]
+    else:
+        pool = multiprocessing.Pool(processes, _init_search,
+                                    (multiprocessing.Event(),))
+        results = pool.map(_search, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    best = min(results, key=lambda r:(r['score'], r['seed']))
+    return rebuild_presentation(best), best
+
+def good_presentation(manifold, tries=10, processes=1, seconds=None):
+    return presentation_search(manifold, tries, processes, seconds)[0]
+
+def order_via_magma(group, coset_limit=250000):
     if group.num_generators() == 0:
         return 1
     G = sage.all.magma(group)
-    return G.Order(CosetLimit=250000).sage()
+    try:
+        return G.Order(CosetLimit=coset_limit).sage()
+    except (RuntimeError, TypeError):  # Enumeration ran out of cosets.
+        return None
+
+def order_via_pool(group, coset_limit=250000):
+    """
+    Like order_via_magma, but through the shared persistent session,
+    giving None when Magma fails or times out.
+    """
+    if group.num_generators() == 0:
+        return 1
+    return magma_pool.default_pool().orders([group], coset_limit)[0]
+
+def order_via_cosets(group, coset_limit=250000):
+    return coset.order(group, coset_limit)
+
+order_engines = {'magma':order_via_magma, 'pool':order_via_pool,
+                 'local':order_via_cosets}
+
+coset_ladder = [1000, 10000, 100000, 250000]
+
+def order_by_ladder(group, engine='magma', ladder=None, stats=None):
+    """
+    Tries the order engine with each coset limit in turn, stopping at
+    the first definite answer.  Returns the order and the limit that
+    gave it, or (None, None), and counts the latter in stats under
+    'cosets_<limit>'.  Finite groups are usually small, so most resolve
+    on the first rung, and only the hard ones pay for the top limit.
+
+    >>> G = snappy.Manifold('m004(1, 0)').fundamental_group()
+    >>> order_by_ladder(G, 'local')
+    (1, 1000)
+    """
+    if ladder is None:
+        ladder = coset_ladder
+    for limit in ladder:
+        order = order_engines[engine](group, limit)
+        if order not in [None, 0]:
+            break
+    else:
+        order, limit = None, None
+    if stats is not None:
+        stats['cosets_%s' % limit] += 1
+    return order, limit
+
+def presentation_record(group):
+    return (group.num_generators(), group.relators())
+
+def betti_number(group):
+    """
+    The first Betti number, computed from the exponent sums of the
+    relators.
+    """
+    n = group.num_generators()
+    rows = [[R.count(chr(ord('a') + i)) - R.count(chr(ord('A') + i))
+             for i in range(n)] for R in group.relators()]
+    if len(rows) == 0:
+        return n
+    return n - sage.all.matrix(sage.all.ZZ, rows).rank()
+
+def finite_group_record(manifold, engine='magma', stats=None, certified=None,
+                        processes=1, seconds=None):
+    """
+    The verdict, order (None when not finite) and the presentation
+    used to decide whether the filling has finite fundamental group.
+    The engine is a key of order_engines; each returns 0, infinity or
+    None when the order isn't found.  The order is tried with the
+    limits of coset_ladder, and 'coset_limit' records the one that
+    settled it.
+
+    Cheap tests come first, and the stage that settled the question
+    is recorded and counted in the collections.Counter stats:
 
-def has_finite_fundamental_group(manifold):
-    M = manifold.high_precision()
-    G = good_presentation(manifold)
+    1. 'trivial': SnapPy's presentation has no generators.
+    2. 'betti': positive first Betti number, so infinite.
+    3. 'hyperbolic': the filling appears hyperbolic, or its
+       dehn.filling_name is in the container 'certified' of fillings
+       already proven hyperbolic, so infinite.
+    4. 'presentation': a good_presentation with at most 1 generator,
+       searched for with the given processes and seconds.
+    5. 'cosets': the order engine, via order_by_ladder.
+    """
+    if stats is None:
+        stats = collections.Counter()
+    G = manifold.fundamental_group()
+    ans = {'presentation':presentation_record(G), 'order':None, 'engine':engine}
     if G.num_generators() == 0:
-        return True
-    elif G.num_generators() == 1:
-        return G.num_relators() == 1  # Exclude pi_1 = Z
-    return order_via_magma(G) not in [0, sage.all.infinity]
+        ans['stage'], ans['finite'], ans['order'] = 'trivial', True, 1
+    elif betti_number(G) > 0:
+        ans['stage'], ans['finite'] = 'betti', False
+    elif (dehn.appears_hyperbolic(manifold) or
+          (certified is not None and dehn.filling_name(manifold) in certified)):
+        ans['stage'], ans['finite'] = 'hyperbolic', False
+    else:
+        G, ans['search'] = presentation_search(manifold, processes=processes,
+                                               seconds=seconds)
+        ans['presentation'] = presentation_record(G)
+        if G.num_generators() == 0:
+            ans['stage'], ans['finite'], ans['order'] = 'presentation', True, 1
+        elif G.num_generators() == 1:
+            ans['stage'] = 'presentation'
+            ans['finite'] = G.num_relators() == 1  # Exclude pi_1 = Z
+            if ans['finite']:
+                R = G.relators()[0]
+                ans['order'] = abs(sum(1 if c.islower() else -1 for c in R))
+        else:
+            ans['stage'] = 'cosets'
+            order, ans['coset_limit'] = order_by_ladder(G, engine, stats=stats)
+            ans['finite'] = order not in [None, 0, sage.all.infinity]
+            if ans['finite']:
+                ans['order'] = int(order)
+    stats[ans['stage']] += 1
+    return ans
+
+def filling_key(manifold):
+    """
+    The key for a Dehn filling on a 1-cusped manifold: the isosig of
+    the unfilled triangulation together with the slope in the framing
+    of snappy.Triangulation(isosig).  When the triangulation has
+    combinatorial symmetries, the smallest of the equivalent slopes
+    is used.
+
+    >>> M = snappy.Manifold('m004(1, 2)')
+    >>> N = snappy.Manifold('m004(-1, 2)')
+    >>> filling_key(M) == filling_key(N)
+    True
+    """
+    a, b = [int(round(x)) for x in manifold.cusp_info(0).filling]
+    T = manifold.without_hyperbolic_structure()
+    T.dehn_fill((0, 0))
+    isosig = T.triangulation_isosig(decorated=False)
+    slopes = []
+    for iso in T.isomorphisms_to(snappy.Triangulation(isosig)):
+        C = iso.cusp_maps()[0]
+        slopes.append(dehn.normalize_slope((int(C[0,0]*a + C[0,1]*b),
+                                            int(C[1,0]*a + C[1,1]*b))))
+    return isosig, min(slopes)
 
-def finite_fillings(manifold):
+def has_finite_fundamental_group(manifold, cache=None, engine='magma',
+                                 stats=None, certified=None, processes=1, seconds=None):
     """
+    If cache is given, e.g. a store.ReprStore, the record from
+    finite_group_record is looked up there under filling_key, and
+    computed and saved if absent.  Hits count as stage 'cache' in
+    stats.
+    """
+    if cache is None:
+        return finite_group_record(manifold, engine, stats, certified,
+                                   processes, seconds)['finite']
+    key = filling_key(manifold)
+    record = cache.get(key)
+    if record is None:
+        record = finite_group_record(manifold, engine, stats, certified,
+                                     processes, seconds)
+        cache[key] = record
+    elif stats is not None:
+        stats['cache'] += 1
+    return record['finite']
+
+def finite_fillings(manifold, cache=None, engine='magma', stats=None,
+                    certified=None, orbits=None, processes=1, seconds=None):
+    """
+    Given orbits, a symmetry.SlopeOrbits, only one slope per orbit of
+    fixed_slopes is filled.  The processes and seconds are for each
+    presentation_search.
+
     >>> M = snappy.Manifold('m003')
     >>> finite_fillings(M)
     [(-2, 1), (-1, 1), (0, 1), (1, 0), (1, 1)]
+    >>> finite_fillings(M, orbits=symmetry.SlopeOrbits(M))
+    [(-2, 1), (-1, 1), (0, 1), (1, 0), (1, 1)]
     """
+    slopes = fixed_slopes if orbits is None else orbits.representatives(fixed_slopes)
     ans = []
-    for slope in fixed_slopes:
+    for slope in slopes:
         M = manifold.copy()
         M.dehn_fill(slope)
-        if has_finite_fundamental_group(M):
+        if has_finite_fundamental_group(M, cache, engine, stats, certified,
+                                        processes, seconds):
             ans.append(slope)
+    if orbits is not None:
+        ans = orbits.spread(fixed_slopes, ans)
     return sorted(ans)
 
 if __name__ == '__main__':
@@ -1,11 +1,18 @@
 """
 Proving that a given closed manifold is hyperbolic.
 """
-import hashlib
+import time, hashlib, multiprocessing
 import snappy
 import taskdb2
 import pandas as pd
 import sage.all
+import magma_pool, lowindex
+
+try:  # Internals of SnapPy's verify_hyperbolicity.
+    from snappy.verify import (KrawczykShapesEngine,
+             check_logarithmic_gluing_equations_and_positively_oriented_tets)
+except ImportError:
+    KrawczykShapesEngine = None
 
 def all_positive(manifold):
     return manifold.solution_type() == 'all tetrahedra positively oriented'
@@ -34,27 +41,233 @@ def find_positive_triangulation(manifold, tries=100):
                 return X
             M.randomize()
 
-def verify_hyperbolic_basic(manifold):
+def integer_fillings(manifold):
+    return [tuple(int(round(x)) for x in f) for f in manifold.cusp_info('filling')]
+
+def certificate_key(manifold):
+    """
+    The key for certificate stores, which for a Dehn filling on a
+    1-cusped manifold is the same as dehn.filling_name.
+    """
+    return manifold.name() + ''.join(repr(f) for f in integer_fillings(manifold))
+
+def refine_shapes(manifold, shapes, bits_prec):
+    """
+    Newton's method, in least squares form, on the rectangular gluing
+    equations, starting from the given approximate shapes.  Returns
+    shapes accurate to about bits_prec and None, or else None and the
+    reason: 'degenerate' if the iteration heads for a degenerate
+    tetrahedron and 'stalled' if it fails to converge, which at low
+    precision can just mean the triangulation is ill-conditioned.
+    """
+    CF = sage.all.ComplexField(bits_prec)
+    tol = sage.all.RealField(bits_prec)(2)**(10 - bits_prec)
+    eqns = manifold.gluing_equations('rect')
+    z = [CF(w) for w in shapes]
+    n = len(z)
+    for i in range(100):
+        if any(w.abs() < 1e-8 or (1 - w).abs() < 1e-8 for w in z):
+            return None, 'degenerate'
+        F, J = [], []
+        for A, B, c in eqns:
+            v = CF(c)
+            for j in range(n):
+                v *= z[j]**A[j] * (1 - z[j])**B[j]
+            F.append(v - 1)
+            J.append([v*(A[j]/z[j] - B[j]/(1 - z[j])) for j in range(n)])
+        J, F = sage.all.matrix(CF, J), sage.all.vector(CF, F)
+        Jh = J.conjugate_transpose()
+        step = (Jh*J).solve_right(Jh*F)
+        z = [w - dw for w, dw in zip(z, step)]
+        if max(dw.abs() for dw in step) < tol:
+            return z, None
+    return None, 'stalled'
+
+def verify_at_precision(manifold, bits_prec, shapes):
+    """
+    Tries to verify hyperbolicity starting from approximate shapes,
+    typically those from the previous precision.  Returns the status
+    and the refined shapes; the status is 'verified', 'precision' if
+    more precision might help, including when Newton's method fails
+    to converge, or 'structural' if the triangulation itself is the
+    problem: there is a negatively oriented or degenerate tetrahedron.
+    """
+    if KrawczykShapesEngine is None:
+        try:
+            if manifold.verify_hyperbolicity(bits_prec=bits_prec)[0]:
+                return 'verified', shapes
+        except RuntimeError:
+            print('Treating exception in verify code as a failure')
+        return 'precision', shapes
+    refined, failure = refine_shapes(manifold, shapes, bits_prec)
+    if failure == 'stalled':
+        return 'precision', shapes
+    if failure == 'degenerate' or min(z.imag() for z in refined) < 0:
+        return 'structural', refined
+    shapes = refined
+    engine = KrawczykShapesEngine(manifold, shapes, bits_prec=bits_prec)
+    if not engine.expand_until_certified():
+        return 'precision', shapes
+    if any(z.imag().upper() < 0 for z in engine.certified_shapes):
+        return 'structural', shapes
+    try:
+        check_logarithmic_gluing_equations_and_positively_oriented_tets(
+            manifold, engine.certified_shapes)
+        return 'verified', shapes
+    except RuntimeError:
+        return 'precision', shapes
+
+def verify_with_escalation(manifold, timings=None):
+    """
+    Tries bits_prec = 53, 106, ..., 848 in turn, each warm-started
+    from the shapes found at the previous level.  Returns the status
+    from verify_at_precision and the precision where it stopped.  If
+    given, the list timings gets a (bits_prec, status, seconds) for
+    each level.
+    """
+    shapes = manifold.tetrahedra_shapes('rect')
+    prec = 53
+    while prec < 1000:
+        start = time.time()
+        status, new_shapes = verify_at_precision(manifold, prec, shapes)
+        if timings is not None:
+            timings.append((prec, status, round(time.time() - start, 3)))
+        if status != 'precision':
+            return status, prec
+        if new_shapes is not None:
+            shapes = new_shapes
+        prec = 2*prec
+    return 'precision', prec
+
+def basic_certificate(manifold, timings=None, switches=3):
+    """
+    Proves the manifold hyperbolic as in verify_hyperbolic_basic and
+    returns a certificate, or None on failure.  The certificate is a
+    dict giving the decorated isosig and Dehn fillings of the
+    triangulation that worked and the precision at which it did.  A
+    structural failure moves on to a new triangulation, up to
+    'switches' times.
+    """
     M = find_positive_triangulation(manifold)
-    if M is not None:
-        prec = 53
-        while prec < 1000:
-            try:
-                if M.verify_hyperbolicity(bits_prec=prec)[0]:
-                    return True
-            except RuntimeError:
-                print('Treating exception in verify code as a failure')
-            prec = 2*prec                
-    return False
+    for i in range(switches):
+        if M is None:
+            return
+        status, prec = verify_with_escalation(M, timings)
+        if status == 'verified':
+            return {'isosig':M.triangulation_isosig(decorated=True),
+                    'filling':integer_fillings(M), 'bits_prec':prec}
+        if status != 'structural':
+            return
+        M = M.copy()
+        M.randomize()
+        M = find_positive_triangulation(M)
+
+def verify_hyperbolic_basic(manifold):
+    return basic_certificate(manifold) is not None
+
+def _cover_certificate(job):
+    degree, i, isosig, filling = job
+    C = snappy.Manifold(isosig)
+    C.dehn_fill(filling)
+    cert = basic_certificate(C)
+    if cert is not None:
+        cert['cover'] = (degree, i)
+    return cert
+
+def cover_jobs(manifold, degree):
+    """
+    The covers of the given degree, as picklable jobs for
+    _cover_certificate.  All have the same number of tetrahedra, so
+    those whose SnapPy solution is already all positive come first,
+    as they need no search for a positive triangulation.
+    """
+    covers = sorted(enumerate(manifold.covers(degree)),
+                    key=lambda iC:(not all_positive(iC[1]), iC[0]))
+    return [(degree, i, C.triangulation_isosig(decorated=True), integer_fillings(C))
+            for i, C in covers]
+
+def cover_certificate(manifold, max_degree=6, processes=1):
+    """
+    Tries to prove some cover of degree at most max_degree hyperbolic,
+    cheapest first: by degree, then as in cover_jobs.  The covers
+    of a given degree are only built once all smaller degrees have
+    failed, and with several processes the pool is terminated as soon
+    as any cover succeeds.  Returns that cover's certificate, with
+    'cover' giving its degree and position in manifold.covers(degree),
+    or None.
+    """
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for d in range(1, max_degree + 1):
+            jobs = cover_jobs(manifold, d)
+            if pool is None:
+                results = (_cover_certificate(job) for job in jobs)
+            else:
+                results = pool.imap_unordered(_cover_certificate, jobs)
+            for cert in results:
+                if cert is not None:
+                    return cert
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def hyperbolicity_certificate(manifold, processes=1, timings=None):
+    """
+    The certificate from basic_certificate, falling back on
+    cover_certificate if the manifold itself fails.
+    """
+    cert = basic_certificate(manifold, timings)
+    if cert is None:
+        cert = cover_certificate(manifold, processes=processes)
+    return cert
 
-def is_hyperbolic(manifold):
-    if verify_hyperbolic_basic(manifold):
+def check_certificate(certificate):
+    """
+    Redoes the proof recorded in the certificate with a single call to
+    verify_hyperbolicity.  For covers, this proves the recorded cover
+    hyperbolic; that it covers the original manifold is taken from
+    the certificate.
+
+    >>> cert = hyperbolicity_certificate(snappy.Manifold('m004(5, 1)'))
+    >>> check_certificate(cert)
+    True
+    """
+    M = snappy.Manifold(certificate['isosig'])
+    M.dehn_fill(certificate['filling'])
+    try:
+        return bool(M.verify_hyperbolicity(bits_prec=certificate['bits_prec'])[0])
+    except RuntimeError:
+        return False
+
+def find_certificate(manifold, certificates=None, processes=1, timings=None):
+    """
+    A hyperbolicity certificate for the manifold, or None, using the
+    given number of processes to search covers if need be.  The
+    timings are as in verify_with_escalation, for the manifold itself.
+    If given, certificates is a dict-like object such as a
+    store.ReprStore, keyed by certificate_key.  A certificate found
+    there is rechecked instead of searching afresh, and new
+    certificates are saved to it.  The same store can be passed as
+    'certified' to finite.finite_group_record.
+    """
+    if certificates is not None:
+        key = certificate_key(manifold)
+        cert = certificates.get(key)
+        if cert is not None and check_certificate(cert):
+            return cert
+    cert = hyperbolicity_certificate(manifold, processes, timings)
+    if cert is not None and certificates is not None:
+        certificates[key] = cert
+    return cert
+
+def is_hyperbolic(manifold, certificates=None, processes=1, timings=None):
+    """
+    Returns True if the manifold is proven hyperbolic, via
+    find_certificate.
+    """
+    if find_certificate(manifold, certificates, processes, timings) is not None:
         return True
-    else:
-        for d in range(1, 7):
-            for C in manifold.covers(d):
-                if verify_hyperbolic_basic(C):
-                    return True
 
 def basic_test():
     df = pd.read_csv('closed.csv.bz2')
@@ -73,10 +286,15 @@ def basic_test_2():
 def create_db():
     df = pd.read_csv('closed.csv.bz2')
     cols = [('verified', 'tinyint'), ('volume', 'double'), ('inj', 'double'),
-            ('chern_simons', 'double'), ('group_hash', 'text')]
+            ('chern_simons', 'double'), ('group_hash', 'text'),
+            ('verify_timings', 'text')]
     exdb = taskdb2.ExampleDatabase('closed_02', df['name'], cols)
     return exdb
 
+# Worker processes for the cover search in the task functions; raise
+# this when the cluster jobs are given more than one core.
+cover_processes = 1
+
 def basic_invariants(task):
     name = task['name']
     base, fill = name.split('(')
@@ -85,7 +303,11 @@ def basic_invariants(task):
     M.dehn_fill(eval('(' + fill))
     task['volume'] = float(M.volume())
     task['chern_simons'] = float(M.chern_simons())
-    if is_hyperbolic(M.low_precision()):
+    timings = []
+    verified = is_hyperbolic(M.low_precision(), processes=cover_processes,
+                             timings=timings)
+    task['verify_timings'] = repr(timings)
+    if verified:
         task['verified'] = True
         task['done'] = True
 
@@ -120,6 +342,41 @@ def basic_magma_hash_lite(M, index=6):
     raw_hash = hash_magma_group(G, index+1, lite=True)
     return (index, 'lite', hashlib.md5(repr(raw_hash)).hexdigest())
 
+def magma_hashes(manifolds, index=6, lite=False, pool=None):
+    """
+    The values of basic_magma_hash, or basic_magma_hash_lite, for many
+    manifolds at once via a magma_pool.MagmaPool, with None where
+    Magma failed or timed out.
+    """
+    if pool is None:
+        pool = magma_pool.default_pool()
+    groups = [M.fundamental_group() for M in manifolds]
+    ans = []
+    for raw_hash in pool.raw_hashes(groups, index + 1, lite):
+        if raw_hash is None:
+            ans.append(None)
+        else:
+            digest = hashlib.md5(repr(sorted(raw_hash))).hexdigest()
+            ans.append((index, 'lite', digest) if lite else (index, digest))
+    return ans
+
+def local_group_hashes(M):
+    """
+    The values of basic_magma_hash(M) and basic_magma_hash_lite(M, 10),
+    computed without Magma from a single lowindex.SubgroupLattice, so
+    the index 7 subgroups are found once and shared.
+    """
+    L = lowindex.SubgroupLattice.from_group(M.fundamental_group())
+    full = (6, lowindex.md5_hash(L.raw_hash(7)))
+    lite = (10, 'lite', lowindex.md5_hash(L.raw_hash(11, lite=True)))
+    return full, lite
+
+def add_group_hashes_local(task):
+    M = snappy.Manifold(task['name'])
+    full, lite = local_group_hashes(M)
+    task['group_hash'], task['group_hash_10'] = repr(full), repr(lite)
+    task['done'] = True
+
 def add_magma_hash(task):
     name = task['name']
     M = snappy.Manifold(name)
@@ -144,15 +401,75 @@ def add_magma_hash_simple_quo(task):
     task['group_hash_simple'] = hashlib.md5(repr(raw_hash)).hexdigest()
     task['done'] = True
 
+def magma_hashes_simple_quo(manifolds, pool=None):
+    """
+    Batched version of the hash in add_magma_hash_simple_quo.
+    """
+    if pool is None:
+        pool = magma_pool.default_pool()
+    groups = [M.fundamental_group() for M in manifolds]
+    return [None if raw_hash is None else hashlib.md5(repr(sorted(raw_hash))).hexdigest()
+            for raw_hash in pool.simple_quotient_hashes(groups)]
+
+def systole_upper_bound(manifold):
+    """
+    The length of the shortest of the cores of the filled cusps and the
+    dual curves, which are closed geodesics, or None if there are none.
+    """
+    lengths = [c.core_length.real() for c in manifold.cusp_info()
+               if not c.is_complete]
+    lengths += [d['filled_length'].real() for d in manifold.dual_curves()]
+    return min(lengths) if lengths else None
+
+class LengthSpectrum:
+    """
+    The length spectrum of a hyperbolic manifold, computed from a
+    single Dirichlet domain that is built on first use.  The longest
+    part of the spectrum found so far is kept, so that queries with a
+    smaller cutoff cost nothing.
+
+    >>> L = LengthSpectrum(snappy.ManifoldHP('m004(5, 1)'))
+    >>> s = L.systole()
+    >>> L.up_to(s)[0].length.real() == s
+    True
+    """
+    def __init__(self, manifold):
+        self.manifold = manifold
+        self._domain = None
+        self.cutoff, self.spectrum = 0, []
+
+    def domain(self):
+        if self._domain is None:
+            try:
+                self._domain = self.manifold.dirichlet_domain()
+            except RuntimeError:
+                self._domain = self.manifold.dirichlet_domain(centroid_at_origin=False)
+        return self._domain
+
+    def up_to(self, cutoff):
+        if cutoff > self.cutoff:
+            self.spectrum = self.domain().length_spectrum_dicts(cutoff)
+            self.cutoff = cutoff
+        return [g for g in self.spectrum if g.length.real() <= cutoff]
+
+    def systole(self, growth=1.5):
+        """
+        The length of the shortest geodesic.  The search starts just
+        past systole_upper_bound, so usually only one pass is needed,
+        and otherwise the cutoff is increased by the factor growth.
+        """
+        bound = systole_upper_bound(self.manifold)
+        cutoff = 1.01*bound if bound is not None else 0.51
+        spec = self.up_to(cutoff)
+        while len(spec) == 0:
+            cutoff = growth*cutoff
+            spec = self.up_to(cutoff)
+        return spec[0].length.real()
+
 def add_injectivity_radius(task):
     M = snappy.ManifoldHP(task['name'])
-    radius = 0.34
-    spec = []
     try:
-        while len(spec) == 0:
-            radius = 1.5*radius
-            spec = M.length_spectrum(radius)
-        task['inj'] = float(spec[0].length.real())
+        task['inj'] = float(LengthSpectrum(M).systole())
         task['done'] = True
     except RuntimeError:
         return
@@ -167,23 +484,11 @@ def add_injectivity_cusped(task):
             task['inj'] = float(likely_systole)
             task['done'] = True
             return
-        cutoff = 1.1 * likely_systole
-    else:
-        cutoff = 0.34
-    spec = []
-    while len(spec) == 0:
-        try:
-            radius = 1.5*cutoff
-            spec = M.length_spectrum(cutoff)
-        except RuntimeError:
-            try:
-                D = M.dirichlet_domain(centroid_at_origin=False)
-                spec = D.length_spectrum_dicts(cutoff)
-            except RuntimeError:
-                return 
-
-    task['inj'] = float(spec[0].length.real())
-    task['done'] = True
+    try:
+        task['inj'] = float(LengthSpectrum(M).systole())
+        task['done'] = True
+    except RuntimeError:
+        return
 
 def add_homology(task):
     """
@@ -0,0 +1,347 @@
+"""
+Low-index subgroups of finitely presented groups, computed without
+Magma, for the group hashes in hyperbolic.py.
+
+Subgroups of index at most n correspond to transitive actions on n
+points, which are found by Sims' backtrack search for complete coset
+tables; see Chapter 5 of Sims' "Computation with finitely presented
+groups".  The search tree is kept, in the form of the branches that
+were cut off at the current index bound, so the bound can be raised
+later without redoing the work.
+"""
+
+import heapq, hashlib, collections
+import sage.all
+from coset import parse_word, free_reduce
+
+def scan(T, c, R):
+    """
+    Scan the relator R at coset c of the partial table T, filling in
+    the table if there is a gap of length one.  Returns None if this
+    contradicts the relator, the deduced (coset, column) if there was
+    one, and otherwise False.
+    """
+    f, i, n = c, 0, len(R)
+    while i < n and T[f][R[i]] >= 0:
+        f = T[f][R[i]]
+        i += 1
+    if i == n:
+        return False if f == c else None
+    b, j = c, n - 1
+    while j > i and T[b][R[j] ^ 1] >= 0:
+        b = T[b][R[j] ^ 1]
+        j -= 1
+    if j == i:
+        if T[b][R[i] ^ 1] >= 0:
+            return None
+        T[f][R[i]] = b
+        T[b][R[i] ^ 1] = f
+        return (f, R[i])
+    return False
+
+def rerooting_is_smaller(T, root):
+    """
+    Whether renumbering the cosets of the partial table T so that
+    root becomes 0, and the others in order of first appearance,
+    gives a table which is already known to be lexicographically
+    smaller than T however T is completed.  When T is complete, the
+    renumbered table is that of the conjugate subgroup stabilizing
+    root.
+    """
+    new = {root:0}
+    order = [root]
+    # The order grows during the loop, so this can't use zip, which
+    # is eager in Python 2.
+    for k, old_row in enumerate(T):
+        if k >= len(order):
+            return False
+        for d, e in zip(T[order[k]], old_row):
+            if d < 0 or e < 0:
+                return False
+            if d not in new:
+                new[d] = len(order)
+                order.append(d)
+            if new[d] != e:
+                return new[d] < e
+    return False
+
+def sparse_abelian_invariants(rows, num_cols):
+    """
+    The AQInvariants, in Magma's sense, of the abelian group with
+    num_cols generators and the relations in rows, each a dict from
+    column to nonzero coefficient.  As with Tietze moves, a relation
+    where some generator has coefficient +/-1 is used to eliminate
+    that generator, shortest relations first, which keeps the rows
+    sparse; only what is left goes to a dense Smith form.
+
+    >>> sparse_abelian_invariants([{0:2}, {1:1, 2:-1}, {2:3}], 4)
+    [6, 0]
+    >>> sparse_abelian_invariants([{0:1, 1:1}, {0:1, 1:-1}], 2)
+    [2]
+    """
+    rows = dict((i, dict(r)) for i, r in enumerate(rows) if r)
+    where = collections.defaultdict(set)
+    for i, r in rows.items():
+        for c in r:
+            where[c].add(i)
+    heap = [(len(r), i) for i, r in rows.items()]
+    heapq.heapify(heap)
+    gens = num_cols
+    while heap:
+        n, i = heapq.heappop(heap)
+        r = rows.get(i)
+        if r is None or len(r) != n:
+            continue
+        units = [c for c, e in r.items() if abs(e) == 1]
+        if not units:
+            continue
+        c = min(units, key=lambda c:len(where[c]))
+        del rows[i]
+        for d in r:
+            where[d].discard(i)
+        for j in where.pop(c):
+            s = rows[j]
+            f = s[c]*r[c]
+            for d, e in r.items():
+                v = s.get(d, 0) - f*e
+                if v:
+                    s[d] = v
+                    where[d].add(j)
+                elif d in s:
+                    del s[d]
+                    where[d].discard(j)
+            if s:
+                heapq.heappush(heap, (len(s), j))
+            else:
+                del rows[j]
+        gens -= 1
+    if not rows:
+        return [0]*gens
+    cols = sorted(set(c for r in rows.values() for c in r))
+    index = dict((c, k) for k, c in enumerate(cols))
+    dense = []
+    for r in rows.values():
+        row = [0]*len(cols)
+        for c, e in r.items():
+            row[index[c]] = e
+        dense.append(row)
+    A = sage.all.matrix(sage.all.ZZ, dense)
+    torsion = sorted(int(e) for e in A.elementary_divisors() if e > 1)
+    return torsion + [0]*(gens - A.rank())
+
+class SubgroupLattice:
+    """
+    The subgroups of a finitely presented group, up to conjugacy,
+    found so far, stored as complete coset tables.  Like Magma's
+    LowIndexSubgroups, there is one subgroup per conjugacy class.
+
+    >>> L = SubgroupLattice(2, ['aa', 'bbb', 'abababab'])
+    >>> [len(L.subgroups(n)) for n in [1, 2, 3, 4, 6, 24]]
+    [1, 2, 3, 4, 7, 11]
+    >>> L.raw_hash(3, lite=True)
+    [[1, 1, [2]], [2, 2, [3]], [3, 6, [2, 2]]]
+
+    This is S4, and its hash agrees with the definitions in Magma's
+    hyperbolic.hash_magma_group, worked out by hand from the classes
+    S4, A4, D4, S3, Z4 and the normal and non-normal Klein 4-groups:
+
+    >>> expected = [[1, 1, [2], [2]], [2, 2, [3], [3]], [3, 6, [2, 2], [2, 2]],
+    ...             [4, 24, [2], []], [6, 6, [2, 2], [2, 2]],
+    ...             [6, 24, [2, 2], []], [6, 24, [4], []]]
+    >>> L.raw_hash(7) == expected
+    True
+    >>> md5_hash(L.raw_hash(7)) == md5_hash(expected)
+    True
+    """
+    def __init__(self, num_gens, relators):
+        self.num_gens, self.num_cols = num_gens, 2*num_gens
+        rels = [free_reduce(parse_word(R, num_gens)) for R in relators]
+        self.relators = [R for R in rels if R]
+        # The cyclic conjugates of the relators and their inverses,
+        # sorted by first letter, for processing deductions.
+        self.conjugates = [[] for x in range(self.num_cols)]
+        for R in self.relators:
+            for W in [R, [x ^ 1 for x in reversed(R)]]:
+                for i in range(len(W)):
+                    V = W[i:] + W[:i]
+                    if V not in self.conjugates[V[0]]:
+                        self.conjugates[V[0]].append(V)
+        self.max_index = 0
+        self.tables = []
+        root = [[-1]*self.num_cols]
+        self.frontier = [(root, False)]
+        self._invariants = dict()
+
+    def _deduce(self, T, c, x):
+        # Process the consequences of the new entry T[c][x], returning
+        # False on a contradiction.
+        queue = [(c, x)]
+        while queue:
+            c, x = queue.pop()
+            for e, y in [(c, x), (T[c][x], x ^ 1)]:
+                for R in self.conjugates[y]:
+                    result = scan(T, e, R)
+                    if result is None:
+                        return False
+                    if result:
+                        queue.append(result)
+        return True
+
+    def _is_canonical(self, T):
+        return not any(rerooting_is_smaller(T, r) for r in range(1, len(T)))
+
+    def _check_root(self, T):
+        # The one-coset table needs its own check, as there are no
+        # deductions to trigger scanning relators of the form x^n.
+        for R in self.relators:
+            result = scan(T, 0, R)
+            if result is None or (result and not self._deduce(T, *result)):
+                return False
+        return True
+
+    def _search(self, T, new_coset, max_index):
+        # Explore the subtree at the partial table T.  If new_coset,
+        # the first step is to send the first undefined entry to a new
+        # coset.  Branches needing more than max_index cosets are
+        # saved in the frontier.
+        stack = [(T, new_coset)]
+        while stack:
+            T, new_coset = stack.pop()
+            undefined = [(c, x) for c in range(len(T))
+                         for x in range(self.num_cols) if T[c][x] < 0]
+            if not undefined:
+                if self._is_canonical(T):
+                    self.tables.append(tuple(tuple(row) for row in T))
+                continue
+            c, x = undefined[0]
+            if new_coset:
+                k = len(T)
+                if k >= max_index:
+                    self.frontier.append((tuple(tuple(row) for row in T), True))
+                    continue
+                S = [list(row) for row in T] + [[-1]*self.num_cols]
+                S[c][x], S[k][x ^ 1] = k, c
+                if self._deduce(S, c, x) and self._is_canonical(S):
+                    stack.append((S, False))
+                continue
+            stack.append((T, True))
+            for d in reversed(range(len(T))):
+                if T[d][x ^ 1] < 0:
+                    S = [list(row) for row in T]
+                    S[c][x], S[d][x ^ 1] = d, c
+                    if self._deduce(S, c, x) and self._is_canonical(S):
+                        stack.append((S, False))
+
+    def extend(self, max_index):
+        """
+        Find all subgroups of index at most max_index, resuming from
+        where the last search stopped.
+        """
+        if max_index <= self.max_index:
+            return
+        frontier, self.frontier = self.frontier, []
+        for T, new_coset in frontier:
+            T = [list(row) for row in T]
+            if new_coset or self._check_root(T):
+                self._search(T, new_coset, max_index)
+        self.max_index = max_index
+
+    def subgroups(self, max_index):
+        """
+        The coset tables of the subgroups of index at most max_index,
+        where the subgroup is the stabilizer of coset 0.
+        """
+        self.extend(max_index)
+        return [T for T in self.tables if len(T) <= max_index]
+
+    def abelian_invariants(self, T):
+        """
+        The AQInvariants, in Magma's sense, of the subgroup with coset
+        table T, computed from its Reidemeister-Schreier presentation,
+        with the generators on a spanning tree already eliminated.
+        """
+        k = len(T)
+        tree = set()
+        seen = {0}
+        order = [0]
+        for c in order:
+            for x in range(self.num_cols):
+                d = T[c][x]
+                if d not in seen:
+                    seen.add(d)
+                    order.append(d)
+                    tree.add((c, x//2) if x % 2 == 0 else (d, x//2))
+        gens = [(c, i) for c in range(k) for i in range(self.num_gens)
+                if (c, i) not in tree]
+        column = dict((g, j) for j, g in enumerate(gens))
+        rows = []
+        for c in range(k):
+            for R in self.relators:
+                row = collections.defaultdict(int)
+                d = c
+                for x in R:
+                    e = T[d][x]
+                    g = (d, x//2) if x % 2 == 0 else (e, x//2)
+                    if g in column:
+                        row[column[g]] += 1 if x % 2 == 0 else -1
+                    d = e
+                rows.append(dict((j, v) for j, v in row.items() if v))
+        return sparse_abelian_invariants(rows, len(gens))
+
+    def core_table(self, T):
+        """
+        The coset table of the core of the subgroup with table T, that
+        is, the regular representation of the permutation group by
+        which G acts on the cosets of the subgroup.
+        """
+        identity = tuple(range(len(T)))
+        index = {identity:0}
+        elements = [identity]
+        table = []
+        for g in elements:
+            row = []
+            for x in range(self.num_cols):
+                h = tuple(T[p][x] for p in g)
+                if h not in index:
+                    index[h] = len(elements)
+                    elements.append(h)
+                row.append(index[h])
+            table.append(row)
+        return table
+
+    def core_index(self, T):
+        gens = [[T[c][2*i] + 1 for c in range(len(T))] for i in range(self.num_gens)]
+        return int(sage.all.PermutationGroup(gens).order())
+
+    def invariants(self, T, lite=False):
+        """
+        The entry for T in the hashes of hyperbolic.subgroup_hash,
+        computed once per subgroup and shared between full and lite
+        hashes.
+        """
+        if T not in self._invariants:
+            self._invariants[T] = [len(T), self.core_index(T), self.abelian_invariants(T)]
+        ans = self._invariants[T]
+        if not lite and len(ans) == 3:
+            ans.append(self.abelian_invariants(self.core_table(T)))
+        return ans[:3] if lite else list(ans)
+
+    def raw_hash(self, index, lite=False):
+        """
+        The same as hyperbolic.hash_magma_group(G, index, lite).
+        """
+        return sorted(self.invariants(T, lite) for T in self.subgroups(index))
+
+    @staticmethod
+    def from_group(group):
+        """
+        The lattice for a SnapPy fundamental group.
+        """
+        return SubgroupLattice(group.num_generators(), group.relators())
+
+def md5_hash(raw_hash):
+    return hashlib.md5(repr(raw_hash)).hexdigest()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,201 @@
+"""
+Magma sessions that stay alive between calls and are sent many groups
+per round trip.
+
+Each batch of groups becomes one Magma script, which appends a tagged
+record per group to a file as soon as that group is done.  Errors
+inside Magma, e.g. a coset enumeration running out of room, are caught
+there and reported as None.  The file is watched while the script
+runs, so the time limit applies to each group: if no record turns up
+in time, the session is killed and restarted, the first group without
+a record gets None, and the batch resumes after it, keeping the
+records already written.
+"""
+
+import os, re, time, signal, tempfile, threading
+import sage.all
+
+# Magma versions of hyperbolic.subgroup_hash and friends, defined once
+# per session.
+magma_prelude = """
+SetColumns(0);
+function SubHash(G, H, lite)
+  C := Core(G, H);
+  ans := [* Index(G, H), Index(G, C), AQInvariants(H) *];
+  if not lite then Append(~ans, AQInvariants(C)); end if;
+  return ans;
+end function;
+function RawHash(G, index, lite)
+  return [* SubHash(G, H, lite) : H in LowIndexSubgroups(G, <1, index>) *];
+end function;
+function SimpleHash(G)
+  ans := [* *];
+  for homs in SimpleQuotients(G, 10000 : Limit := 10^10) do
+    for h in homs do
+      Append(~ans, SubHash(G, sub<G | h>, true));
+    end for;
+  end for;
+  return ans;
+end function;
+"""
+
+# A record is only complete once its closing @@ is written.
+tagged_value = re.compile(r'@@(\d+)@@([^@]*)@@')
+
+def parse_magma_value(text):
+    """
+    >>> parse_magma_value('[* 6, 6, [ 2, 0 ] *]')
+    [6, 6, [2, 0]]
+    """
+    text = text.replace('[*', '[').replace('*]', ']')
+    return eval(text, {'Infinity':sage.all.infinity})
+
+def batch_script(groups, expr, path):
+    """
+    One script computing expr, a Magma expression in G, for each of
+    the SnapPy groups, appending the records to the file at path.
+    """
+    lines = []
+    for k, group in enumerate(groups):
+        lines += ['try',
+                  '  G := %s;' % group.magma_string(),
+                  '  PrintFile("%s", Sprintf("@@%%o@@%%o@@", %d, %s));' % (path, k, expr),
+                  'catch e',
+                  '  PrintFile("%s", "@@%d@@None@@");' % (path, k),
+                  'end try;']
+    return '\n'.join(lines)
+
+def read_records(path):
+    """
+    The complete records in the file at path, as a dict from index
+    to value.
+    """
+    try:
+        text = open(path).read()
+    except IOError:
+        return dict()
+    return dict((int(k), parse_magma_value(' '.join(value.split())))
+                for k, value in tagged_value.findall(text))
+
+class MagmaPool:
+    """
+    A pool of 'size' Magma sessions, each driven by its own thread.
+    Groups are sent in batches of batch_size, and each group is
+    allowed 'timeout' seconds.
+    """
+    def __init__(self, size=1, batch_size=100, timeout=600):
+        self.size, self.batch_size, self.timeout = size, batch_size, timeout
+        self.sessions = [None]*size
+        self.restarts = 0
+
+    def session(self, i):
+        if self.sessions[i] is None:
+            M = sage.all.Magma()
+            M.eval(magma_prelude)
+            self.sessions[i] = M
+        return self.sessions[i]
+
+    def restart(self, i):
+        M, self.sessions[i] = self.sessions[i], None
+        self.restarts += 1
+        if M is not None:
+            try:
+                os.kill(M.pid(), signal.SIGKILL)
+            except (OSError, TypeError):
+                pass
+            try:
+                M.quit()
+            except Exception:
+                pass
+
+    def _eval(self, i, groups, expr):
+        # Returns the records written, and whether the script finished.
+        # If some group goes self.timeout seconds without a new record,
+        # or Magma crashes, the session is restarted.
+        fd, path = tempfile.mkstemp(suffix='.magma')
+        os.close(fd)
+        result = {}
+        def target():
+            try:
+                result['out'] = self.session(i).eval(batch_script(groups, expr, path))
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        count, progress = 0, time.time()
+        while thread.is_alive() and time.time() - progress < self.timeout:
+            thread.join(1)
+            records = read_records(path)
+            if len(records) > count:
+                count, progress = len(records), time.time()
+        finished = not thread.is_alive() and 'out' in result
+        if not finished:
+            self.restart(i)
+            thread.join(60)
+        records = read_records(path)
+        os.remove(path)
+        return records, finished
+
+    def _run_batch(self, i, groups, expr):
+        ans = [None]*len(groups)
+        start = 0
+        while start < len(groups):
+            records, finished = self._eval(i, groups[start:], expr)
+            for k, value in records.items():
+                ans[start + k] = value
+            missing = set(range(len(groups) - start)) - set(records)
+            if finished or not missing:
+                break
+            # The first group without a record is the one that hung.
+            start += min(missing) + 1
+        return ans
+
+    def run(self, groups, expr):
+        """
+        Evaluate expr, a Magma expression in G, on each of the SnapPy
+        groups; None marks errors and timeouts.
+        """
+        groups = list(groups)
+        batches = [range(k, min(k + self.batch_size, len(groups)))
+                   for k in range(0, len(groups), self.batch_size)]
+        ans = [None]*len(groups)
+        lock = threading.Lock()
+        def worker(i):
+            while True:
+                with lock:
+                    if not batches:
+                        return
+                    batch = batches.pop(0)
+                values = self._run_batch(i, [groups[k] for k in batch], expr)
+                for k, value in zip(batch, values):
+                    ans[k] = value
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return ans
+
+    def orders(self, groups, coset_limit=250000):
+        return self.run(groups, 'Order(G : CosetLimit := %d)' % coset_limit)
+
+    def raw_hashes(self, groups, index, lite=False):
+        """
+        The unsorted data behind hyperbolic.hash_magma_group.
+        """
+        return self.run(groups, 'RawHash(G, %d, %s)' % (index, 'true' if lite else 'false'))
+
+    def simple_quotient_hashes(self, groups):
+        return self.run(groups, 'SimpleHash(G)')
+
+_default_pool = None
+
+def default_pool():
+    """
+    A single session shared by everything in this process.
+    """
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = MagmaPool()
+    return _default_pool
@@ -6,7 +6,7 @@ ideal triangulations.
 
 import snappy
 import pandas as pd
-import dehn, hyperbolic, finite
+import dehn, hyperbolic, finite, store, census
 
 o11_A_isosig = 'lLLLLQMMcbeffihiihjkkxxhxscksbtxr_aBBb'
 o11_B_isosig = 'lLLLwMPQccddeghikkjjkhswtrlugscfn_BbBa'
@@ -22,27 +22,29 @@ C = snappy.Manifold('m004')
 
 
 def classify_fillings(M, closed):
+    """
+    Here closed is a census.ClosedCensus.
+    """
     ans = dict()
     slopes = dehn.hyperbolic_dehn_fillings(M)
+    M = M.copy()
+    try:
+        M.chern_simons()  # Needed for the Chern-Simons of the fillings.
+    except (ValueError, RuntimeError):
+        pass
     for slope in slopes:
         C = M.copy()
         C.dehn_fill(slope)
-        vol = C.volume()
-        matches = closed[abs(closed.volume - vol) < 1e-6]
-        for i, row in matches.iterrows():
-            X = snappy.Manifold(row['name'])
-            try:
-                if X.is_isometric_to(C):
-                    ans[tuple(slope)] = str(row['name'])
-            except RuntimeError:
-                pass
+        name = closed.identify(C)
+        if name is not None:
+            ans[tuple(slope)] = str(name)
     return ans
 
-def manifold_info(manifold, closed_table):
+def manifold_info(manifold, closed_table, finite_cache=None):
     ans = dict()
     ans['name'] = manifold.name()
     ans['isosig'] = manifold.triangulation_isosig()
-    ans['finite'] = finite.finite_fillings(manifold)
+    ans['finite'] = finite.finite_fillings(manifold, finite_cache)
     ans['fillings'] = classify_fillings(manifold, closed_table)
     for slope in ans['finite']:
         ans['fillings'][slope] = 'finite'
@@ -59,17 +61,18 @@ def save_extras(extras=None, closed_table=None):
             M.set_name('X_%d' % i)
             extras.append(M)
     if closed_table is None:
-        closed_table = pd.read_csv('closed.csv.bz2')
+        closed_table = census.ClosedCensus(pd.read_csv('closed.csv.bz2'))
     extra = [manifold_info(M, closed_table) for M in extras]
     data = pd.DataFrame(data=extra, columns=columns)
     data.to_csv('extra_cusped_2.csv', index=False)
 
 
-closed_table = pd.read_csv('closed.csv.bz2')
+closed_table = census.ClosedCensus(pd.read_csv('closed.csv.bz2'))
+finite_cache = store.ReprStore('finite_cache.sqlite')
 
 def process_manifold_info(task):
     manifold = snappy.Manifold(task['isosig'])
-    finite_fill = finite.finite_fillings(manifold)
+    finite_fill = finite.finite_fillings(manifold, finite_cache)
     all_fill = classify_fillings(manifold, closed_table)
     for slope in finite_fill:
         all_fill[slope] = 'finite'
@@ -0,0 +1,124 @@
+"""
+Screening the Dehn fillings of a 1-cusped manifold in double
+precision, only redoing the borderline ones in quad-double.
+"""
+
+import collections
+import snappy
+import dehn
+
+def solution_valid(M):
+    try:
+        M.tetrahedra_shapes(bits_prec=212)
+        return True
+    except ValueError:
+        return False
+
+class TwoTierScreen:
+    """
+    Classifies Dehn fillings by first solving the gluing equations in
+    double precision.  A slope is escalated to quad-double only when
+    the double precision answer is in doubt: the solution type is
+    anything other than 'all tetrahedra positively oriented', the
+    volume is near 0, or the core or shortest dual curve has length
+    near 0 or near the threshold.  The counter 'stats' records how
+    many slopes were decided at each tier.
+
+    >>> S = TwoTierScreen(snappy.Manifold('s000'))
+    >>> len(S.fat_fillings(0.2))
+    16
+    >>> sum(S.stats[k] for k in ['tier1', 'tier2']) == len(S.slopes(7.6))
+    True
+    """
+    def __init__(self, manifold, margin=1e-6):
+        self.low = manifold.low_precision()
+        self.lattice = dehn.NormalizedCuspLattice(self.low)
+        self.margin = margin
+        self.stats = collections.Counter()
+        self.solves = collections.Counter()
+        self._high, self._high_lattice = None, None
+
+    def high(self):
+        if self._high is None:
+            self._high = self.low.high_precision()
+        return self._high
+
+    def high_lattice(self):
+        if self._high_lattice is None:
+            self._high_lattice = dehn.NormalizedCuspLattice(self.high())
+        return self._high_lattice
+
+    def slopes(self, max_length):
+        """
+        The primitive elements up to max_length, using the quad-double
+        cusp shape for any slope whose length is too close to call.
+        """
+        eps = 1e-8
+        L = self.lattice
+        ans = []
+        for s in L.primitive_elements(max_length*(1 + eps)):
+            if L.norm(s) > max_length*(1 - eps):
+                self.stats['lattice_tier2'] += 1
+                if self.high_lattice().norm(s) > max_length:
+                    continue
+            ans.append(s)
+        return ans
+
+    def _clean(self, M):
+        if M.solution_type() != 'all tetrahedra positively oriented':
+            return False
+        if M.volume() < self.margin:
+            return False
+        return M.cusp_info(0).core_length.real() >= self.margin
+
+    def _high_filling(self, slope):
+        M = self.high().copy()
+        M.dehn_fill(slope, 0)
+        return M
+
+    def is_fat(self, M, slope, min_core_geod):
+        """
+        Decide dehn.is_fat_filling for the double precision filling M
+        along slope, escalating if needed.
+        """
+        if self._clean(M):
+            c = M.cusp_info(0).core_length.real()
+            d = M.dual_curves()[0]['filled_length'].real()
+            if all(abs(x - min_core_geod) >= self.margin for x in [c, d]):
+                self.stats['tier1'] += 1
+                return min(c, d) >= min_core_geod
+        self.stats['tier2'] += 1
+        return dehn.is_fat_filling(self._high_filling(slope), min_core_geod)
+
+    def fat_fillings(self, min_core_geod=0.2, orbits=None):
+        """
+        Same answer as dehn.hyperbolic_dehn_fillings on the quad-double
+        manifold.  Given orbits, a symmetry.SlopeOrbits, only one
+        slope per orbit is filled.
+        """
+        max_length = dehn.slope_cutoff(min_core_geod)[0]
+        slopes = self.slopes(max_length)
+        todo = slopes if orbits is None else orbits.representatives(slopes)
+        order = dehn.continuation_order(self.lattice, todo)
+        fat = set()
+        for s, M in dehn.fillings_by_continuation(self.low, order, self.solves):
+            if self.is_fat(M, s, min_core_geod):
+                fat.add(tuple(s))
+        fat = [s for s in todo if tuple(s) in fat]
+        return fat if orbits is None else orbits.spread(slopes, fat)
+
+    def hyperbolic_candidate(self, slope):
+        """
+        Returns the filled manifold if it appears hyperbolic with
+        usable shapes, and None otherwise; in the former case, it may
+        be low or high precision.
+        """
+        M = self.low.copy()
+        M.dehn_fill(slope, 0)
+        if self._clean(M):
+            self.stats['tier1'] += 1
+            return M
+        self.stats['tier2'] += 1
+        M = self._high_filling(slope)
+        if dehn.appears_hyperbolic(M) and solution_valid(M):
+            return M
@@ -0,0 +1,217 @@
+"""
+Computing many invariants of a closed manifold from a single solved
+Dehn filling, so that a new column doesn't mean solving for the shapes
+of every manifold in the census again.
+"""
+
+import zlib, collections
+import snappy
+import taskdb2
+import hyperbolic
+
+def parse_filling_name(name):
+    """
+    >>> parse_filling_name('m003(-3,1)')
+    ('m003', [(-3, 1)])
+    >>> parse_filling_name('m125(1, 2)(0, 0)')
+    ('m125', [(1, 2), (0, 0)])
+    """
+    base, rest = name.split('(', 1)
+    fillings = [tuple(int(x) for x in f.split(','))
+                for f in rest.rstrip(')').split(')(')]
+    return base, fillings
+
+class BaseCache:
+    """
+    The most recently used cusped manifolds, solved in quad-double
+    precision with their Chern-Simons invariant computed, up to 'size'
+    of them.  Fillings of the same base start from a copy, so the
+    complete structure is only solved once per base.
+
+    >>> B = BaseCache(size=1)
+    >>> M, N = B.copy('m004'), B.copy('m004')
+    >>> B.stats['miss'], B.stats['hit']
+    (1, 1)
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.manifolds = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def copy(self, base):
+        if base in self.manifolds:
+            self.stats['hit'] += 1
+            M = self.manifolds.pop(base)
+        else:
+            self.stats['miss'] += 1
+            M = snappy.ManifoldHP(base)
+            M.chern_simons()
+            if len(self.manifolds) >= self.size:
+                self.manifolds.popitem(last=False)
+        self.manifolds[base] = M
+        return M.copy()
+
+base_cache = BaseCache()
+
+class FillingSession:
+    """
+    A Dehn filling solved once in quad-double precision, with each
+    invariant computed the first time it is asked for.  As in
+    hyperbolic.basic_invariants, the Chern-Simons invariant of the
+    unfilled manifold is computed before filling, as SnapPy needs.
+    If given, the solved base manifold comes from the BaseCache bases.
+    Invariants of the group or triangulation alone come from an
+    unsolved triangulation instead, so they never wait for the shapes.
+
+    >>> S = FillingSession('m004(5,1)')
+    >>> S.homology()['H_1']
+    '[5]'
+    >>> S.volume() == S.volume()
+    True
+    """
+    def __init__(self, name, certificates=None, bases=None):
+        self.name = name
+        self.base, self.fillings = parse_filling_name(name)
+        self.certificates, self.bases = certificates, bases
+        self._manifold = None
+        self._values = dict()
+
+    def manifold(self):
+        if self._manifold is None:
+            if self.bases is not None:
+                M = self.bases.copy(self.base)
+            else:
+                M = snappy.ManifoldHP(self.base)
+                M.chern_simons()
+            M.dehn_fill(self.fillings)
+            self._manifold = M
+        return self._manifold
+
+    def triangulation(self):
+        # Not kept, as it is cheap to rebuild and sessions can be many.
+        T = snappy.Triangulation(self.base)
+        T.dehn_fill(self.fillings)
+        return T
+
+    def _cached(self, key, compute):
+        if key not in self._values:
+            self._values[key] = compute()
+        return self._values[key]
+
+    def volume(self):
+        return self._cached('volume', lambda: float(self.manifold().volume()))
+
+    def chern_simons(self):
+        return self._cached('chern_simons', lambda: float(self.manifold().chern_simons()))
+
+    def homology(self):
+        """
+        The columns of hyperbolic.add_homology.
+        """
+        def compute():
+            H = self.triangulation().homology()
+            order = H.order()
+            return {'H_1':repr(H.elementary_divisors()),
+                    'H_1_order':0 if order == 'infinite' else order,
+                    'betti':H.betti_number()}
+        return self._cached('homology', compute)
+
+    def systole(self):
+        return self._cached('systole', lambda:
+                            float(hyperbolic.LengthSpectrum(self.manifold()).systole()))
+
+    def group_hashes(self):
+        """
+        Both hashes of hyperbolic.local_group_hashes, from a single
+        search for low-index subgroups.
+        """
+        return self._cached('group_hashes', lambda:
+                            hyperbolic.local_group_hashes(self.triangulation()))
+
+    def group_hash(self):
+        return self.group_hashes()[0]
+
+    def group_hash_10(self):
+        return self.group_hashes()[1]
+
+    def simple_quotient_hash(self):
+        return self._cached('simple_quotient_hash', lambda:
+                            hyperbolic.magma_hashes_simple_quo([self.triangulation()])[0])
+
+    def certificate(self):
+        """
+        A hyperbolicity certificate from hyperbolic.find_certificate,
+        together with the timings of its precision ladder, which are
+        empty when a stored certificate was used.
+        """
+        def compute():
+            timings = []
+            cert = hyperbolic.find_certificate(self.manifold().low_precision(),
+                                               self.certificates,
+                                               hyperbolic.cover_processes, timings)
+            return cert, timings
+        return self._cached('certificate', compute)
+
+# How to fill each column from a session.
+invariant_columns = {
+    'volume':lambda S: S.volume(),
+    'chern_simons':lambda S: S.chern_simons(),
+    'H_1':lambda S: S.homology()['H_1'],
+    'H_1_order':lambda S: S.homology()['H_1_order'],
+    'betti':lambda S: S.homology()['betti'],
+    'inj':lambda S: S.systole(),
+    'group_hash':lambda S: repr(S.group_hash()),
+    'verified':lambda S: S.certificate()[0] is not None,
+    'verify_timings':lambda S: repr(S.certificate()[1])}
+
+def add_invariants(task, columns=None):
+    """
+    Fills in the given columns of invariant_columns, by default all
+    those of the task that are still empty, from one FillingSession.
+    A column whose computation fails is left as None, with the failure
+    printed, and the task is then not done.
+    """
+    if columns is None:
+        columns = [c for c in invariant_columns if c in task and task[c] is None]
+    S = FillingSession(task['name'], bases=base_cache)
+    failed = False
+    for column in columns:
+        try:
+            task[column] = invariant_columns[column](S)
+        except RuntimeError as e:
+            print('%s: %s failed: %s' % (task['name'], column, e))
+            task[column] = None
+            failed = True
+    if not failed and ('verified' not in columns or task['verified']):
+        task['done'] = True
+
+def sweep_by_base(db_name, columns, shard=0, num_shards=1, batch=100):
+    """
+    Fill in the given columns of a taskdb2 database wherever the first
+    of them is still empty.  Bases are split among num_shards workers
+    and each worker does all the fillings of a base in a row, so each
+    base is solved once.  Results are written back every 'batch' rows.
+    """
+    exdb = taskdb2.ExampleDatabase(db_name)
+    df = exdb.dataframe()
+    df = df[df[columns[0]].isnull()].copy()
+    df['base'] = df.name.apply(lambda name:parse_filling_name(name)[0])
+    df = df[df.base.apply(lambda base:zlib.crc32(base) % num_shards == shard)]
+    df = df.sort_values(['base', 'name'])
+    done = []
+    def save():
+        for column in columns:
+            exdb.update_column(df.loc[done], column)
+        del done[:]
+    for i, row in df.iterrows():
+        task = dict((column, None) for column in columns)
+        task['name'] = row['name']
+        add_invariants(task, columns)
+        if task.get('done'):
+            for column in columns:
+                df.loc[i, column] = task[column]
+            done.append(i)
+        if len(done) >= batch:
+            save()
+    if done:
+        save()
@@ -0,0 +1,59 @@
+"""
+Persistent caches of computed results.
+"""
+
+import sqlite3
+
+class ReprStore:
+    """
+    A dictionary saved in an sqlite file.  As with the columns of our
+    task databases, keys and values are stored via repr and read back
+    via eval, so stick to tuples, lists, dicts, strings and numbers.
+    Several processes can share the same file.
+
+    >>> S = ReprStore(':memory:')
+    >>> S[('m004', (1, 2))] = {'finite': False}
+    >>> S[('m004', (1, 2))]
+    {'finite': False}
+    >>> ('m004', (1, 3)) in S, len(S)
+    (False, 1)
+    """
+    def __init__(self, path, table='store'):
+        self.path, self.table = path, table
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute('create table if not exists %s '
+                                '(key text primary key, value text)' % table)
+        self.connection.commit()
+
+    def __getitem__(self, key):
+        row = self.connection.execute('select value from %s where key=?' % self.table,
+                                      (repr(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return eval(row[0])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.connection.execute('insert or replace into %s values (?, ?)' % self.table,
+                                (repr(key), repr(value)))
+        self.connection.commit()
+
+    def __contains__(self, key):
+        row = self.connection.execute('select 1 from %s where key=?' % self.table,
+                                      (repr(key),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.connection.execute('select count(*) from %s' % self.table).fetchone()[0]
+
+    def items(self):
+        for key, value in self.connection.execute('select key, value from %s' % self.table):
+            yield eval(key), eval(value)
+
+    def __repr__(self):
+        return '<ReprStore %s:%s>' % (self.path, self.table)
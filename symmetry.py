@@ -0,0 +1,122 @@
+"""
+The action of the symmetry group of a 1-cusped manifold on its
+slopes.  Dehn fillings along slopes in the same orbit are isometric,
+so each stage of the pipeline need only do one slope per orbit.  The
+stages that decide a property of fillings spread each verdict over its
+orbit; only weed, whose output defines the isometry classes, records
+the orbits themselves, via SlopeOrbits.relations.
+"""
+
+import snappy
+
+identity = ((1, 0), (0, 1))
+
+def normalize_slope(slope):
+    """
+    The representative of +/-slope used in our tables, for any
+    sequence of two integers.  This is the one definition, which
+    dehn and weed also use.
+
+    >>> normalize_slope([-2, -3]), normalize_slope((0, -1))
+    ((2, 3), (0, 1))
+    """
+    a, b = [int(x) for x in slope]
+    if a*b == 0:
+        a, b = abs(a), abs(b)
+    elif b < 0:
+        a, b = -a, -b
+    return (a, b)
+
+def act(C, slope):
+    """
+    The image of the slope under the cusp map C.
+
+    >>> act(((0, 1), (1, 0)), (2, 3))
+    (3, 2)
+    """
+    a, b = slope
+    return normalize_slope((C[0][0]*a + C[0][1]*b, C[1][0]*a + C[1][1]*b))
+
+def symmetry_cusp_maps(manifold):
+    """
+    The distinct cusp maps of the self-isometries of the manifold.
+    If SnapPy can't find the isometries, this is just the identity,
+    which is always correct, only slower.
+    """
+    M = manifold.copy()
+    M.dehn_fill((0, 0))
+    maps = {identity}
+    try:
+        for iso in M.is_isometric_to(M, True):
+            C = iso.cusp_maps()[0]
+            maps.add(tuple(tuple(int(C[i,j]) for j in range(2)) for i in range(2)))
+    except RuntimeError:
+        pass
+    return sorted(maps)
+
+class SlopeOrbits:
+    """
+    The orbits of the symmetry group on slopes, given either the
+    manifold or the cusp maps.  Slopes can be tuples or vectors, in
+    any normalization.  Within a list of slopes, the representative
+    of an orbit is its first member in the list.
+
+    >>> O = SlopeOrbits(maps=[identity, ((-1, 0), (0, 1))])
+    >>> O.orbit((1, 2))
+    [(-1, 2), (1, 2)]
+    >>> slopes = [(1, 0), (1, 2), (-1, 2), (2, 1)]
+    >>> O.representatives(slopes)
+    [(1, 0), (1, 2), (2, 1)]
+    >>> O.spread(slopes, [(1, 2)])
+    [(1, 2), (-1, 2)]
+    >>> O.relations('m004', slopes)
+    [('m004(1, 2)', 'm004(-1, 2)')]
+    >>> SlopeOrbits(snappy.Manifold('m004')).orbit((1, 2))
+    [(-1, 2), (1, 2)]
+    """
+    def __init__(self, manifold=None, maps=None):
+        if maps is None:
+            maps = symmetry_cusp_maps(manifold)
+        self.maps = maps
+
+    def orbit(self, slope):
+        return sorted({act(C, normalize_slope(slope)) for C in self.maps})
+
+    def orbit_map(self, slopes):
+        """
+        A dict sending each of the slopes, normalized, to its
+        representative, also normalized.
+        """
+        ans = dict()
+        for s in slopes:
+            s = normalize_slope(s)
+            if s not in ans:
+                for t in self.orbit(s):
+                    ans[t] = s
+        return dict((normalize_slope(s), ans[normalize_slope(s)]) for s in slopes)
+
+    def representatives(self, slopes):
+        reps = self.orbit_map(slopes)
+        return [s for s in slopes if reps[normalize_slope(s)] == normalize_slope(s)]
+
+    def spread(self, slopes, chosen):
+        """
+        The slopes whose representative is one of those chosen.
+        """
+        reps = self.orbit_map(slopes)
+        chosen = {normalize_slope(s) for s in chosen}
+        return [s for s in slopes if reps[normalize_slope(s)] in chosen]
+
+    def relations(self, name, slopes):
+        """
+        The pairs of filling names (representative, other member) for
+        the orbits of the slopes of the named manifold, in the form of
+        weed's precursors.
+        """
+        reps = self.orbit_map(slopes)
+        return [(name + repr(reps[s]), name + repr(s))
+                for s in map(normalize_slope, slopes) if reps[s] != s]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
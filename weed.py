@@ -1,7 +1,9 @@
+import os, array, select, signal, cPickle, collections, multiprocessing
+import numpy
 import snappy
 import taskdb2
 import pandas as pd
-import networkx as nx
+import store, symmetry
 
 fill_col = 'inj_02'
 
@@ -21,67 +23,323 @@ def sort_key(name):
     num_tet = {'m':5, 's':6, 'v':7, 't':8, 'o':9}
     return (num_tet[name[0]], name)
 
-def normalize_slope((a,b)):
-    if a*b == 0:
-        a, b = abs(a), abs(b)
-    elif b < 0:
-        a, b = -a, -b
-    return (a,b)
+normalize_slope = symmetry.normalize_slope
 
-def weed(task):
+# Census identifications of drilled exteriors, shared by all workers;
+# see identify_exterior.  The store is only opened by the first call
+# to weed, so importing this module doesn't create the file.
+exterior_cache_path = 'exterior_cache.sqlite'
+exterior_cache = None
+exterior_stats = collections.Counter()
+
+def open_exterior_cache():
+    global exterior_cache
+    if exterior_cache is None:
+        exterior_cache = store.ReprStore(exterior_cache_path)
+    return exterior_cache
+
+def exterior_key(X):
     """
-    WARNING: For future use, need to include relations caused by
-    symmetries of a fixed 1-cusp manifold.
+    The isometry signature of X including its peripheral curves, so
+    that exteriors with the same key have the same cusp maps to the
+    census.  None if SnapPy can't compute it.
     """
-    name = task['name']
-    manifold = snappy.Manifold(name)
-    slopes = eval(task[fill_col])
+    try:
+        return X.isometry_signature(of_link=True) or None
+    except RuntimeError:
+        return None
+
+def run_with_timeout(function, args, seconds):
+    """
+    Runs function(*args) in a forked child, which is killed if it takes
+    more than 'seconds', as a Python signal handler can't interrupt
+    SnapPy's kernel.  A plain fork is used since pool workers aren't
+    allowed children of their own.  Returns ('ok', value), ('error',
+    None) if the call raised or the child died, or ('timeout', None).
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            try:
+                ans = ('ok', function(*args))
+            except Exception:
+                ans = ('error', None)
+            with os.fdopen(write, 'wb') as file:
+                cPickle.dump(ans, file, 2)
+        finally:
+            os._exit(0)
+    os.close(write)
+    try:
+        if not select.select([read], [], [], seconds)[0]:
+            os.kill(pid, signal.SIGKILL)
+            return ('timeout', None)
+        with os.fdopen(read, 'rb') as file:
+            read = None
+            data = file.read()
+        return cPickle.loads(data) if data else ('error', None)
+    finally:
+        if read is not None:
+            os.close(read)
+        os.waitpid(pid, 0)
+
+def _isometry_cusp_maps(A, B):
+    isos = A.is_isometric_to(B, True)
+    return [tuple(tuple(int(C[i,j]) for j in range(2)) for i in range(2))
+            for C in (iso.cusp_maps()[0] for iso in isos)]
+
+class RetryPolicy:
+    """
+    How hard to try to find the isometries from a drilled exterior to
+    its census manifold.  Each attempt is (randomize, high_precision,
+    seconds): whether to randomize the exterior's triangulation first,
+    whether to switch both to quad-double, and a time limit enforced
+    by run_with_timeout.  The default starts with the two attempts
+    weed always made.
+    """
+    def __init__(self, attempts=None):
+        if attempts is None:
+            attempts = [(False, False, 600), (True, True, 600),
+                        (True, True, 600), (True, False, 600)]
+        self.attempts = attempts
+
+    def cusp_maps(self, X, Y):
+        """
+        The cusp maps of the isometries from X to Y, or None if every
+        attempt failed, along with what happened at each attempt.
+        """
+        outcomes = []
+        for randomize, high_precision, seconds in self.attempts:
+            A, B = X.copy(), Y.copy()
+            if randomize:
+                A.randomize()
+            if high_precision:
+                A, B = A.high_precision(), B.high_precision()
+            outcome, maps = run_with_timeout(_isometry_cusp_maps, (A, B), seconds)
+            if outcome == 'ok':
+                return maps, outcomes
+            outcomes.append(outcome)
+        return None, outcomes
+
+def identify_exterior(X, before, cache=None, stats=None, policy=None):
+    """
+    The name of census.identify(X), or None, and, when that name comes
+    before 'before' in sort_key order, the cusp maps of the isometries
+    from X to it.  Both are looked up in the cache, keyed by
+    exterior_key, and added to it when missing.  Lookups are counted
+    in stats as 'hit' or 'miss'.
+
+    If the RetryPolicy gives up, the cusp maps are None and nothing
+    is cached for them, and the third value lists what happened.
+    """
+    if stats is None:
+        stats = collections.Counter()
+    if policy is None:
+        policy = RetryPolicy()
+    key = exterior_key(X) if cache is not None else None
+    entry = cache.get(key) if key is not None else None
+    changed = entry is None
+    stats['miss' if changed else 'hit'] += 1
+    if entry is None:
+        Y = census.identify(X)
+        entry = {'census':Y.name() if Y else None, 'cusp_maps':None}
+    name, maps, outcomes = entry['census'], [], []
+    if name is not None and sort_key(name) < sort_key(before):
+        if entry['cusp_maps'] is None:
+            maps, outcomes = policy.cusp_maps(X, census[name])
+            if maps is not None:
+                entry['cusp_maps'] = maps
+                changed = True
+        else:
+            maps = entry['cusp_maps']
+    if key is not None and changed:
+        cache[key] = entry
+    return name, maps, outcomes
+
+def weed_unit(manifold, slope, curve, cache=None, stats=None, policy=None):
+    """
+    The relations from drilling the given dual curve, by index, of one
+    filling, and a record of the failure if the isometries couldn't be
+    found.
+    """
+    M = manifold.copy()
+    M.dehn_fill(slope)
+    X = M.drill(curve)
+    X = X.filled_triangulation()
+    Y_name, maps, outcomes = identify_exterior(X, M.name(), cache, stats, policy)
+    filling = M.name() + repr(slope)
+    if maps is None:
+        return [], (filling, curve, Y_name, outcomes)
     weeded = []
+    for C in maps:
+        t = normalize_slope((C[0][0], C[1][0]))
+        weeded.append((filling, Y_name + repr(t)))
+    return weeded, None
+
+def weed_units(manifold, slopes):
+    units = []
     for s in slopes:
         M = manifold.copy()
         M.dehn_fill(s)
-        for i in M.dual_curves():
-            X = M.drill(i)
-            X = X.filled_triangulation()
-            Y = census.identify(X)
-            if Y and sort_key(Y.name()) < sort_key(M.name()):
-                try:
-                    isos = X.is_isometric_to(Y, True)
-                except RuntimeError:
-                    X.randomize()
-                    X = X.high_precision()
-                    Y = Y.high_precision()
-                    try:
-                        isos = X.is_isometric_to(Y, True)
-                    except RuntimeError:
-                        isos = []
-                for iso in isos:
-                    C = iso.cusp_maps()[0]
-                    t = normalize_slope((C[0,0], C[1,0]))
-                    weeded.append((M.name() + repr(s), Y.name() + repr(t)))
+        units += [(s, i) for i in range(len(M.dual_curves()))]
+    return units
+
+_worker_policy = None
+
+def _init_worker(cache_path, policy):
+    # The parent's sqlite connection can't be shared after fork.
+    global exterior_cache, _worker_policy
+    exterior_cache = store.ReprStore(cache_path)
+    _worker_policy = policy
+
+def _weed_unit(job):
+    name, slope, curve = job
+    stats = collections.Counter()
+    weeded, failure = weed_unit(snappy.Manifold(name), slope, curve,
+                                exterior_cache, stats, _worker_policy)
+    return weeded, failure, stats
+
+def weed(task, processes=1, policy=None):
+    """
+    Only one slope per orbit of the symmetry group of the manifold is
+    drilled, and the other slopes in the orbit are related to it
+    directly; these are the relations coming from symmetries.
+
+    With processes > 1, the (slope, dual curve) pairs are spread over
+    a pool of workers.  The hit rate of exterior_cache and the pairs
+    where the RetryPolicy gave up are recorded when the task has
+    'weed_cache' and 'weed_failures' columns, and the task is only
+    done if there were no failures.
+    """
+    name = task['name']
+    manifold = snappy.Manifold(name)
+    slopes = eval(task[fill_col])
+    orbits = symmetry.SlopeOrbits(manifold)
+    units = weed_units(manifold, orbits.representatives(slopes))
+    stats = collections.Counter()
+    weeded, failures = orbits.relations(name, slopes), []
+    if processes == 1:
+        cache = open_exterior_cache()
+        results = (weed_unit(manifold, s, i, cache, stats, policy) + (None,)
+                   for s, i in units)
+    else:
+        # Each worker opens its own connection to the store.
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (exterior_cache_path, policy))
+        results = pool.imap_unordered(_weed_unit, [(name, s, i) for s, i in units])
+    for unit_weeded, failure, unit_stats in results:
+        weeded += unit_weeded
+        if failure is not None:
+            failures.append(failure)
+        if unit_stats is not None:
+            stats.update(unit_stats)
+    if processes > 1:
+        pool.close()
+        pool.join()
+    exterior_stats.update(stats)
     task['precursors'] = repr(sorted(set(weeded)))
-    task['done'] = True
+    if 'weed_cache' in task:
+        task['weed_cache'] = repr(dict(stats))
+    if 'weed_failures' in task:
+        task['weed_failures'] = repr(sorted(failures))
+    if not failures:
+        task['done'] = True
 
 
-def sort_into_classes(df, extra_merges=[]):
+class DisjointSets:
+    """
+    Union-find on names, with the forest stored in compact integer
+    arrays.  Names are added as they are first seen, so edges can be
+    streamed in, and further merges can be made at any time.
+
+    >>> D = DisjointSets()
+    >>> D.union('m003(-1, 1)', 'm004(1, 2)')
+    >>> D.union('m006(1, 0)', 'm007(3, 1)')
+    >>> D.union('m004(1, 2)', 'm003(-1, 1)')
+    >>> sorted(sorted(c) for c in D.classes())
+    [['m003(-1, 1)', 'm004(1, 2)'], ['m006(1, 0)', 'm007(3, 1)']]
+    """
+    def __init__(self):
+        self.names, self.index = [], dict()
+        self.parent, self.size = array.array('i'), array.array('i')
+
+    def add(self, name):
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+            self.parent.append(i)
+            self.size.append(1)
+        return i
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, a, b):
+        i, j = self.find(self.add(a)), self.find(self.add(b))
+        if i != j:
+            if self.size[i] < self.size[j]:
+                i, j = j, i
+            self.parent[j] = i
+            self.size[i] += self.size[j]
+
+    def classes(self):
+        ans = dict()
+        for i, name in enumerate(self.names):
+            ans.setdefault(self.find(i), []).append(name)
+        return list(ans.values())
+
+    def save(self, path):
+        numpy.savez_compressed(path, names=numpy.array(self.names),
+                               parent=numpy.array(self.parent, dtype=numpy.int32),
+                               size=numpy.array(self.size, dtype=numpy.int32))
+
+    @staticmethod
+    def load(path):
+        data = numpy.load(path)
+        D = DisjointSets()
+        D.names = [str(name) for name in data['names']]
+        D.index = dict((name, i) for i, name in enumerate(D.names))
+        D.parent = array.array('i', data['parent'].tolist())
+        D.size = array.array('i', data['size'].tolist())
+        return D
+
+def closed_filling_sets(df):
+    """
+    The DisjointSets of all closed fillings, merged along the
+    precursors, in one pass over the dataframe.
+    """
+    D = DisjointSets()
+    for name, slopes, precursors in zip(df['name'], df[fill_col], df['precursors']):
+        for slope in slopes:
+            D.add(name + repr(slope))
+        for a, b in precursors:
+            D.union(a, b)
+    return D
+
+def sort_into_classes(df, extra_merges=[], sets=None):
     """
     Check the precursors field for missing fillings, then pick the
     minimal element in each equivalence class.
 
     The columns 'precursors' and 'fill_col' should not be strings, but
     rather lists of tuples of stuff.
-    """
-    closed = set()
-    for i, row in df.iterrows():
-        closed.update(row['name'] + repr(slope) for slope in row[fill_col])
 
-    G = nx.Graph()
-    G.add_nodes_from(closed)
-    for i, row in df.iterrows():
-        G.add_edges_from(row['precursors'])
-    G.add_edges_from(extra_merges)
+    If sets, e.g. from DisjointSets.load, is given, the dataframe is
+    not read and the extra_merges are added to it, so a new batch of
+    merges doesn't mean starting over.
+    """
+    if sets is None:
+        sets = closed_filling_sets(df)
+    for a, b in extra_merges:
+        sets.union(a, b)
 
-    classes = [sorted(H, key=sort_key) for H in nx.connected_components(G)]
+    classes = [sorted(H, key=sort_key) for H in sets.classes()]
     classes.sort(key=lambda x:sort_key(x[0]))
 
     ans = pd.DataFrame({'name':[c[0] for c in classes], 'descriptions':classes})
@@ -93,6 +351,26 @@ task = {'name': 'o9_35571', fill_col:'[(-5, 1), (-4, 1), (-3, 1), (-3, 2), (-2,
                 
             
                 
+def isometry_verdict(a, b):
+    """
+    True if the closed manifolds with the given names were shown to be
+    isometric, and False if that failed.  Two fillings of the same
+    cusped manifold need an isometry of the cusped manifold taking one
+    filling to the other.
+    """
+    A = snappy.Manifold(a)
+    B = snappy.Manifold(b)
+    try:
+        if A.name() == B.name():
+            for X in [A, B]:
+                X.set_peripheral_curves('fillings')
+                X.dehn_fill((0,0))
+            isoms = A.is_isometric_to(B, True)
+            return any(i.extends_to_link() for i in isoms)
+        return bool(A.is_isometric_to(B))
+    except RuntimeError:
+        return False
+
 def refine_classes(df):
     """
     Look at the classes where the (volume, group) hashes colide.
@@ -103,25 +381,10 @@ def refine_classes(df):
     merge = []
     bad = []
     for a, b in nontrivial:
-        A = snappy.Manifold(a)
-        B = snappy.Manifold(b)
-        if A.name() == B.name():
-            for X in [A, B]:
-                X.set_peripheral_curves('fillings')
-                X.dehn_fill((0,0))
-            isoms = A.is_isometric_to(B, True)
-            if any(i.extends_to_link() for i in isoms):
-                merge.append((a, b))
-            else:
-                bad.append((a,b))
+        if isometry_verdict(a, b):
+            merge.append((a, b))
         else:
-            try:
-                if A.is_isometric_to(B):
-                    merge.append((a,b))
-            except RuntimeError:
-                bad.append((a,b))
-                
-
+            bad.append((a, b))
     return merge, bad
     
     